@@ -1,5 +1,6 @@
 import os
 import pickle
+from utils.feature_store import load_features
 from collections import defaultdict
 
 def analyze_embeddings(emb_file, data_dict_file):
@@ -7,8 +8,7 @@ def analyze_embeddings(emb_file, data_dict_file):
     print("\n=== Embeddings Analysis ===")
     
     # Load data
-    with open(emb_file, 'rb') as f:
-        feature_embs = pickle.load(f)
+    feature_embs = load_features(emb_file)
     
     with open(data_dict_file, 'rb') as f:
         data_dict = pickle.load(f)
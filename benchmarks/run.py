@@ -0,0 +1,218 @@
+"""
+CPU benchmarks of the inference, training data and report code on synthetic data.
+
+    python -m benchmarks.run                     # run and compare with benchmarks/baselines/cpu.json
+    python -m benchmarks.run --update_baseline   # store the results as the new baseline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import logging
+import platform
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import torch
+
+from benchmarks import synthetic
+from dataset.esd import ESDDataset
+from model.mstcn import MultiStageModel
+from model.transformer import Transformer
+from utils.guis import PhaseCom
+from utils.capture import FrameSource
+from utils.parser import load
+from utils.report_tools import generate_report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baselines", "cpu.json")
+
+
+def measure(func, repeat, warmup=1):
+    """
+    :return: timing statistics of func in ms.
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    times = np.array(times) * 1000
+    return {"median_ms": float(np.median(times)), "p90_ms": float(np.percentile(times, 90)),
+            "mean_ms": float(np.mean(times)), "repeat": repeat}
+
+
+@contextmanager
+def working_dir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def bench_seg_frame(cfg, work_dir, repeat):
+    phasecom = PhaseCom(arg=cfg)
+    scene = synthetic.EndoscopyScene(1280, 720)
+    frames = [cv_img[..., ::-1].copy() for cv_img in (scene.frame(t) for t in range(32))]
+    # Fill the temporal caches, so every measured frame uses full windows
+    for frame in frames:
+        phasecom.seg_frame(frame)
+    frame_iter = iter(range(10 ** 9))
+    return measure(lambda: phasecom.seg_frame(frames[next(frame_iter) % len(frames)]), repeat)
+
+
+def bench_transformer(cfg, work_dir, repeat, seq=512):
+    transformer = Transformer(cfg.mstcn_f_maps, cfg.mstcn_f_dim, cfg.out_classes, cfg.trans_seq, d_model=cfg.mstcn_f_maps)
+    transformer.eval()
+    x = torch.randn(1, cfg.mstcn_f_maps, seq)
+    long_feature = torch.randn(1, seq, cfg.mstcn_f_dim)
+    with torch.no_grad():
+        return measure(lambda: transformer(x, long_feature), repeat)
+
+
+def bench_mstcn(cfg, work_dir, repeat):
+    fusion = MultiStageModel(mstcn_stages=cfg.mstcn_stages, mstcn_layers=cfg.mstcn_layers,
+                             mstcn_f_maps=cfg.mstcn_f_maps, mstcn_f_dim=cfg.mstcn_f_dim,
+                             out_features=cfg.out_classes, mstcn_causal_conv=True, is_train=False)
+    fusion.eval()
+    x = torch.randn(1, cfg.mstcn_f_dim, cfg.seq)
+    with torch.no_grad():
+        return measure(lambda: fusion(x), repeat)
+
+
+def bench_esd_getitem(is_train):
+    def bench(cfg, work_dir, repeat):
+        with open(cfg.data_file, "rb") as f:
+            data_dict = pickle.load(f)
+        dataset = ESDDataset(data_dict=data_dict, data_idxs=[0, 1], is_train=is_train)
+        idx_iter = iter(range(10 ** 9))
+        return measure(lambda: dataset[next(idx_iter) % len(dataset)], repeat)
+    return bench
+
+
+def bench_decode(cfg, work_dir, repeat):
+    def decode():
+        cap = FrameSource(cfg.video_path, cfg.display_ratio or 1, cfg.down_ratio)
+        while cap.read()[0]:
+            pass
+        cap.release()
+    return measure(decode, repeat)
+
+
+def bench_generate_report(cfg, work_dir, repeat):
+    with working_dir(work_dir):
+        return measure(lambda: generate_report(cfg.log_dir), repeat, warmup=0)
+
+
+BENCHMARKS = {
+    "phasecom_seg_frame": (bench_seg_frame, 50),
+    "transformer_forward": (bench_transformer, 20),
+    "mstcn_forward": (bench_mstcn, 20),
+    "esd_getitem_train": (bench_esd_getitem(True), 50),
+    "esd_getitem_test": (bench_esd_getitem(False), 50),
+    "generate_report": (bench_generate_report, 2),
+    "video_decode": (bench_decode, 5),
+}
+
+
+def prepare(work_dir):
+    """
+    Synthetic data and random checkpoints in work_dir, and configs pointing to them.
+    """
+    cfg = load(os.path.join(ROOT, "configs", "test.yml"))
+    cfg.device = "cpu"
+    cfg.backend = "torch"
+    cfg.resnet_precision = "fp32"
+    synthetic.write_checkpoints(work_dir, cfg)
+    cfg.data_file = synthetic.write_data_dict(os.path.join(work_dir, "frames"))
+    cfg.video_path = synthetic.write_video(os.path.join(work_dir, "video.avi"), 100)
+    cfg.log_dir = os.path.join(work_dir, "logs")
+    os.makedirs(cfg.log_dir)
+    synthetic.write_session_logs(cfg.log_dir)
+    # generate_report reads the template from ./configs of the working directory
+    os.symlink(os.path.join(ROOT, "configs"), os.path.join(work_dir, "configs"))
+    return cfg
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: names of benchmarks whose median is slower than the baseline by more than tolerance.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            logging.info("{:<22s} {:>10.2f} ms  (no baseline)".format(name, result["median_ms"]))
+            continue
+        ratio = result["median_ms"] / baseline[name]["median_ms"]
+        flag = "REGRESSION" if ratio > 1 + tolerance else "ok"
+        logging.info("{:<22s} {:>10.2f} ms  baseline {:>10.2f} ms  x{:.2f}  {}".format(
+            name, result["median_ms"], baseline[name]["median_ms"], ratio, flag))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", default=None, type=str, help="Comma separated benchmarks to run")
+    parser.add_argument("--out", default="bench_results.json", type=str, help="File to save the results")
+    parser.add_argument("--baseline", default=BASELINE_FILE, type=str, help="Baseline results to compare with")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="Allowed relative slowdown of the median")
+    parser.add_argument("--update_baseline", default=False, action='store_true', help="Save the results as baseline")
+    parser.add_argument("--threads", default=None, type=int, help="Number of torch CPU threads")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    names = list(BENCHMARKS.keys()) if args.only is None else args.only.split(",")
+
+    work_dir = tempfile.mkdtemp(prefix="aiendo_bench_")
+    try:
+        with working_dir(ROOT):  # ESDDataset loads its parameters relative to the repository
+            cfg = prepare(work_dir)
+            results = {}
+            for name in names:
+                func, repeat = BENCHMARKS[name]
+                logging.info("Running {}".format(name))
+                results[name] = func(cfg, work_dir, repeat)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {"meta": {"python": platform.python_version(), "torch": torch.__version__,
+                       "machine": platform.machine(), "processor": platform.processor(),
+                       "threads": torch.get_num_threads(), "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+              "results": results}
+    with open(args.out, "w") as f:
+        json.dump(output, f, indent=2)
+    logging.info("Results saved to {}".format(args.out))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+        logging.info("Baseline saved to {}".format(args.baseline))
+        return 0
+    if not os.path.isfile(args.baseline):
+        logging.info("No baseline found at {}".format(args.baseline))
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        logging.error("Slower than baseline: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
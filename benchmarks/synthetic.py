@@ -0,0 +1,136 @@
+"""
+Synthetic inputs of the benchmarks: endoscopy-like videos and frames, random-weight checkpoints and
+session logs, so the benchmarks run without patient data or trained models.
+"""
+import os
+import pickle
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+
+from model.resnet import ResNet
+from model.mstcn import MultiStageModel
+from model.transformer import Transformer
+
+PHASES = ["idle", "marking", "injection", "dissection"]
+
+
+class EndoscopyScene(object):
+    """
+    Frames of a slowly moving reddish tissue texture with specular highlights, a grey instrument and the
+    dark circular border of an endoscope image.
+    """
+    def __init__(self, width=1280, height=720, seed=0):
+        self.width = width
+        self.height = height
+        self.rng = np.random.default_rng(seed)
+        # Low-frequency tissue texture, twice the frame size so it can pan
+        noise = self.rng.random((height // 8, width // 4)).astype(np.float32)
+        noise = cv2.resize(cv2.GaussianBlur(noise, (0, 0), 3), (2 * width, 2 * height))
+        tissue = np.stack([60 + 60 * noise, 70 + 70 * noise, 150 + 100 * noise], axis=2)  # BGR
+        self.tissue = np.clip(tissue, 0, 255).astype(np.uint8)
+        yy, xx = np.mgrid[:height, :width]
+        radius = np.sqrt((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / (0.55 * width)
+        self.vignette = np.clip(1.2 - radius ** 4, 0, 1)[..., None].astype(np.float32)
+
+    def frame(self, t):
+        """
+        :param t: frame index.
+        :return: BGR uint8 frame  [height, width, 3]
+        """
+        x = int((np.sin(t / 50.) + 1) / 2 * self.width)
+        y = int((np.cos(t / 70.) + 1) / 2 * self.height)
+        frame = self.tissue[y:y + self.height, x:x + self.width].copy()
+        for i in range(3):
+            center = (int(self.width * (0.3 + 0.2 * i + 0.05 * np.sin(t / 10. + i))), int(self.height * (0.4 + 0.1 * i)))
+            cv2.circle(frame, center, 6 + 2 * i, (235, 240, 250), -1)
+        tip = (int(self.width * (0.5 + 0.2 * np.sin(t / 30.))), int(self.height * (0.5 + 0.1 * np.cos(t / 25.))))
+        cv2.line(frame, (self.width, self.height), tip, (150, 150, 150), 40)
+        return (frame * self.vignette).astype(np.uint8)
+
+
+def write_video(video_file, num_frames, width=1280, height=720, fps=25, seed=0):
+    """
+    MJPG video of the synthetic scene, decoded by the capture benchmark.
+    """
+    scene = EndoscopyScene(width, height, seed)
+    writer = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    for t in range(num_frames):
+        writer.write(scene.frame(t))
+    writer.release()
+    return video_file
+
+
+def write_data_dict(folder, num_videos=2, num_frames=64, width=1280, height=720):
+    """
+    Frames saved as images with random phase labels, in the data_dict format read by ESDDataset.
+    :return: path of the pickled data_dict.
+    """
+    data_dict = {}
+    rng = np.random.default_rng(0)
+    for v in range(num_videos):
+        scene = EndoscopyScene(width, height, seed=v)
+        video_folder = os.path.join(folder, "Video{}".format(v + 1))
+        if not os.path.isdir(video_folder):
+            os.makedirs(video_folder)
+        img_files = []
+        for t in range(num_frames):
+            img_file = os.path.join(video_folder, "Image{:05d}.png".format(t + 1))
+            cv2.imwrite(img_file, scene.frame(t * 25))
+            img_files.append(img_file)
+        data_dict["Video{}".format(v + 1)] = {"img": img_files, "phase": rng.integers(0, 4, num_frames).tolist()}
+    data_file = os.path.join(folder, "data_dict.pkl")
+    with open(data_file, "wb") as f:
+        pickle.dump(data_dict, f)
+    return data_file
+
+
+def write_checkpoints(folder, cfg, seed=0):
+    """
+    Random-weight checkpoints in the formats loaded by PhaseCom, the paths are set in cfg.
+    """
+    torch.manual_seed(seed)
+    resnet = ResNet(out_channels=cfg.out_classes, has_fc=True, pretrained=False)
+    cfg.resnet_model = os.path.join(folder, "resnet50.pth")
+    torch.save({"model": resnet.state_dict()}, cfg.resnet_model)
+
+    fusion = MultiStageModel(mstcn_stages=cfg.mstcn_stages, mstcn_layers=cfg.mstcn_layers,
+                             mstcn_f_maps=cfg.mstcn_f_maps, mstcn_f_dim=cfg.mstcn_f_dim,
+                             out_features=cfg.out_classes, mstcn_causal_conv=True, is_train=False)
+    cfg.fusion_model = os.path.join(folder, "fusion.pth")
+    torch.save(fusion.state_dict(), cfg.fusion_model)
+
+    transformer = Transformer(cfg.mstcn_f_maps, cfg.mstcn_f_dim, cfg.out_classes, cfg.trans_seq, d_model=cfg.mstcn_f_maps)
+    cfg.trans_model = os.path.join(folder, "transformer.pth")
+    torch.save(transformer.state_dict(), cfg.trans_model)
+    return cfg
+
+
+def write_session_logs(folder, case_name="Case1", num_rows=3600, seed=0):
+    """
+    Session log in the CSV format of online.py with phase segments of random length.
+    """
+    rng = np.random.default_rng(seed)
+    phases = []
+    while len(phases) < num_rows:
+        phases += [PHASES[rng.integers(0, 4)]] * int(rng.integers(20, 200))
+    phases = phases[:num_rows]
+    phases[-1] = "dissection"  # The report divides by the dissection time
+    start = datetime(2024, 1, 1, 9, 0, 0)
+    times = [(start + timedelta(seconds=i)).strftime("%d/%m/%Y-%H:%M:%S.%f") for i in range(num_rows)]
+    pd_log = pd.DataFrame({"Time": times,
+                           "Frame": [str(i * 5).zfill(7) for i in range(num_rows)],
+                           "Trainee": ["A"] * num_rows,
+                           "Trainer": ["B"] * num_rows,
+                           "Bed": ["1"] * num_rows,
+                           "Status": [["Indepedent", "Help", "TakeOver"][i * 3 // num_rows] for i in range(num_rows)],
+                           "FPS": ["{:>7.4f}".format(5.) for _ in range(num_rows)],
+                           "Prediction": phases,
+                           "Correction": ["--"] * num_rows,
+                           "Combine": phases})
+    log_file = os.path.join(folder, "{}_A_session.csv".format(case_name))
+    pd_log.to_csv(log_file, index=False, header=True)
+    return log_file
@@ -24,7 +24,12 @@ from PyQt5.QtWidgets import QMainWindow, QFileDialog
 from PyQt5.QtWidgets import QWidget, QPushButton, QDialog, QLabel
 
 from utils.parser import ParserUse
-from utils.guis import PhaseCom
+from utils.guis import PhaseCom, TEXT_ORIGINS
+from utils.capture import FrameSource
+from utils.recorder import VideoRecorder
+from utils.display import DisplayWorker
+from utils.overlay import TextOverlay
+from utils.session_log import SessionLog, export_csv
 from utils.report_tools import generate_report, get_meta
 
 warnings.filterwarnings("ignore")
@@ -33,21 +38,30 @@ class VideoThread(QThread):
     change_pixmap_signal = pyqtSignal(np.ndarray)
     process_img_signal = pyqtSignal(np.ndarray, int)
 
+    def __init__(self, display_ratio=1, infer_ratio=1):
+        """
+        :param display_ratio: every display_ratio-th frame is displayed.
+        :param infer_ratio: every infer_ratio-th frame is sent to process_img, frames in between are not decoded.
+        """
+        super().__init__()
+        self.display_ratio = display_ratio
+        self.infer_ratio = infer_ratio
+
     def run(self):
-        frame_idx = 0
         # capture from web cam
-        cap = cv2.VideoCapture(0)
+        cap = FrameSource(0, self.display_ratio, self.infer_ratio)
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1440)
         time.sleep(0.5)
         if cap.isOpened():
             while True:
-                frame_idx += 1
-                ret, cv_img = cap.read()
+                ret, cv_img, frame_idx, display, infer = cap.read()
                 # time.sleep(0.10)
                 if ret:
-                    self.change_pixmap_signal.emit(cv_img)
-                    self.process_img_signal.emit(cv_img, frame_idx)
+                    if display:
+                        self.change_pixmap_signal.emit(cv_img)
+                    if infer:
+                        self.process_img_signal.emit(cv_img, frame_idx)
                 else:
                     assert "Cannot get frame"
         else:
@@ -69,9 +83,12 @@ class Ui_iPhaser(QMainWindow):
         if not os.path.isdir(self.save_folder):
             os.makedirs(self.save_folder)
         self.down_ratio = cfg.down_ratio
+        self.display_ratio = cfg.display_ratio or 1
+        self.record_segment = cfg.record_segment or 600
+        self.record_queue = cfg.record_queue or 64
         self.start_time = "--:--:--"
         self.trainee_name = "--"
-        self.manual_set = "--"
+        self.manual = ("--", 0.)  # Manual phase and the time it expires, replaced as a whole by keyPressEvent
 
         # Statue parameters
         self.init_status()
@@ -79,8 +96,8 @@ class Ui_iPhaser(QMainWindow):
         # self.FRAME_WIDTH = 1920
         # self.FRAME_HEIGHT = 1440
         # self.stream_fps = 50
-        self.MANUAL_FRAMES = self.stream_fps * cfg.manual_set_fps_ratio
-        self.manual_frame = 0
+        # Manual settings hold for manual_set_fps_ratio seconds
+        self.MANUAL_SECONDS = cfg.manual_set_fps_ratio
         # self.FRAME_WIDTH = 1280
         # self.FRAME_HEIGHT = 720
         self.CODEC = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
@@ -88,7 +105,6 @@ class Ui_iPhaser(QMainWindow):
         self.date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S.%f")
         self.fps = 0
         self.pred = "--"
-        self.log_data = []
 
         self.phaseseg = PhaseCom(arg=cfg)
 
@@ -99,6 +115,14 @@ class Ui_iPhaser(QMainWindow):
         self.DisplayVideo.setStyleSheet("background-color: rgb(197, 197, 197);")
         self.DisplayVideo.setText("")
         self.DisplayVideo.setObjectName("DisplayVideo")
+        # Frames are scaled and annotated in the display worker, the GUI thread swaps pixmaps at the screen refresh rate
+        self.display = DisplayWorker(self.disply_width, self.display_height, self.update_image)
+        # Recorded frames keep the source resolution and have their own text cache
+        self.record_overlay = TextOverlay(TEXT_ORIGINS)
+        refresh_rate = QtWidgets.QApplication.primaryScreen().refreshRate() or 60
+        self.display_timer = QtCore.QTimer(self)
+        self.display_timer.timeout.connect(self.repaint_display)
+        self.display_timer.start(max(1, int(1000 / refresh_rate)))
 
         self.layoutWidget = QtWidgets.QWidget(self.centralwidget)
         self.layoutWidget.setGeometry(QtCore.QRect(50, 10, 1200, 34))
@@ -226,9 +250,9 @@ class Ui_iPhaser(QMainWindow):
         QtCore.QMetaObject.connectSlotsByName(self)
 
         # create the video capture thread
-        self.thread = VideoThread()
+        self.thread = VideoThread(self.display_ratio, self.down_ratio)
         # connect its signal to the update_image slot
-        self.thread.change_pixmap_signal.connect(self.update_image)
+        self.thread.change_pixmap_signal.connect(self.show_frame, Qt.DirectConnection)
         self.thread.process_img_signal.connect(self.process_img)
         # start the thread
         self.thread.start()
@@ -264,7 +288,6 @@ class Ui_iPhaser(QMainWindow):
     # Buttons
     def click_start(self):
         self.WORKING = True
-        self.log_data = []
         self.Start.setEnabled(False)
         self.Stop.setEnabled(True)
         self.ActionIndependent.setEnabled(True)
@@ -281,8 +304,10 @@ class Ui_iPhaser(QMainWindow):
         self.BedName.setEnabled(False)
         self.CaseName.setEnabled(False)
         self.log_file = os.path.join(self.save_folder, self.case_name + "_" + self.trainee_name + "_" + self.start_time.replace(":", "-") + ".csv")
+        self.session_log = SessionLog(self.log_file.replace(".csv", ".session"))
         video_file_name = os.path.join(self.save_folder, self.case_name + "_" + self.trainee_name + "_" + self.start_time.replace(":", "-") + ".avi")
-        self.output_video = cv2.VideoWriter(video_file_name, self.CODEC, self.stream_fps, (self.FRAME_WIDTH, self.FRAME_HEIGHT))
+        self.output_video = VideoRecorder(video_file_name, max(1, self.stream_fps // self.display_ratio), codec=self.CODEC,
+                                          segment_seconds=self.record_segment, max_queue=self.record_queue, rgb=True)
         # self.DisplayTrainee.setText(self.trainee_name)
 
     def click_stop(self):
@@ -290,7 +315,7 @@ class Ui_iPhaser(QMainWindow):
         self.save_log_data()
         self.label.setText("--:--:--")
         self.init_status()
-        self.output_video.release()
+        self.output_video.close()
         self.TraineeName.setEnabled(True)
         self.TrainerName.setEnabled(True)
         self.BedName.setEnabled(True)
@@ -342,23 +367,10 @@ class Ui_iPhaser(QMainWindow):
         self.ActionTakeOver.setEnabled(False)
 
     def save_log_data(self):
-        datas = zip(*self.log_data)
-        data_dict = {}
-        names = ["Time", "Frame", "Trainee", "Trainer", "Bed", "Status", "FPS", "Prediction", "Correction"]
-        for name, data in zip(names, datas):
-            data_dict[name] = list(data)
-        pd_log = pd.DataFrame.from_dict(data_dict)
-        preds = pd_log["Prediction"].tolist()
-        correcs = pd_log["Correction"].tolist()
-        combines = []
-        for pred, corr in zip(preds, correcs):
-            if corr == "--":
-                combines.append(pred)
-            else:
-                combines.append(corr)
-        pd_log["Combine"] = combines
+        self.session_log.close()
         curent_date_time = "_" + datetime.now().strftime("%H-%M-%S") + ".csv"
-        pd_log.to_csv(self.log_file.replace(".csv", curent_date_time), index=False, header=True)
+        export_csv(self.session_log.log_file, self.log_file.replace(".csv", curent_date_time))
+        os.remove(self.session_log.log_file)
 
     def get_frame_size(self):
         capture = cv2.VideoCapture(0)
@@ -373,7 +385,7 @@ class Ui_iPhaser(QMainWindow):
     def process_img(self, cv_img, frame_idx):
         cv_img = cv_img[30:1050, 695:1850]
         rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-        if frame_idx % self.down_ratio == 0 and self.WORKING:
+        if self.WORKING:
             self.date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S.%f")
             start_time = time.time()
             self.pred = self.phaseseg.seg_frame(rgb_image)
@@ -382,51 +394,57 @@ class Ui_iPhaser(QMainWindow):
             self.fps = 1/np.round(end_time - start_time, 3)
 
             # add log data
-            self.log_data.append([self.date_time, str(frame_idx).zfill(7), self.trainee_name, self.trainer_name, self.bed_name, self.STATUS, "{:>7.4f}".format(self.fps), self.pred, self.manual_set])
+            self.session_log.append([self.date_time, str(frame_idx).zfill(7), self.trainee_name, self.trainer_name, self.bed_name, self.STATUS, "{:>7.4f}".format(self.fps), self.pred, self.manual_phase()])
 
     def keyPressEvent(self, e):
+        manual_keys = {"a": "idle", "s": "marking", "d": "injection", "f": "dissection"}
         pressed_key = e.text()
-        if pressed_key == "a":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "idle"
-        elif pressed_key == "s":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "marking"
-        elif pressed_key == "d":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "injection"
-        elif pressed_key == "f":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "dissection"
-
-    def update_image(self, cv_img):
-        """Convert from an opencv image to QPixmap"""
-        # Collect settings of functional keys
-        # cv_img = cv_img[30:1050, 695:1850]
-        rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-        self.manual_frame = self.manual_frame - 1
-        if self.manual_frame <= 0:
-            self.manual_frame = 0
-            self.manual_set = "--"
-        if self.INIT:
-            self.date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S")
-            if self.manual_frame > 0:
-                self.pred = self.manual_set
-            rgb_image = self.phaseseg.add_text(self.date_time, self.pred, self.trainee_name, rgb_image)
-        if self.WORKING:
+        if pressed_key in manual_keys:
+            self.manual = (manual_keys[pressed_key], time.time() + self.MANUAL_SECONDS)
+
+    def manual_phase(self):
+        """Manual phase set by the keys, "--" once it expired"""
+        phase, expire_time = self.manual
+        return phase if time.time() < expire_time else "--"
+
+    def draw_text(self, rgb_image, overlay=None):
+        """Draw the time, phase and trainee on an RGB frame in place, a manual phase overrides the prediction"""
+        manual = self.manual_phase()
+        pred = manual if manual != "--" else self.pred
+        date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S")
+        self.phaseseg.add_text(date_time, pred, self.trainee_name, rgb_image, overlay)
+
+    def show_frame(self, cv_img):
+        """Record a displayed frame and hand it over to the display worker, called in the capture thread"""
+        if self.WORKING and hasattr(self, 'output_video'):
+            # Converting makes the recorder's own full-resolution copy, the source frame goes on to the display
+            rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+            if self.INIT:
+                self.draw_text(rgb_image, self.record_overlay)
             self.output_video.write(rgb_image)
+        self.display.put(cv_img)
+
+    def update_image(self, rgb_image):
+        """Draw the overlay on a display-sized RGB frame, called in the display worker thread"""
+        if self.INIT:
+            self.draw_text(rgb_image)
+
+    def repaint_display(self):
+        """Show the newest prepared frame, called by the display timer"""
+        rgb_image = self.display.latest()
+        if rgb_image is None:
+            return
         h, w, ch = rgb_image.shape
         bytes_per_line = ch * w
         convert_to_Qt_format = QtGui.QImage(rgb_image.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888)
-        p = convert_to_Qt_format.scaled(self.disply_width, self.display_height, Qt.KeepAspectRatio)
-        p = QPixmap.fromImage(p)
-        self.DisplayVideo.setPixmap(p)
+        self.DisplayVideo.setPixmap(QPixmap.fromImage(convert_to_Qt_format))
 
 if __name__ == "__main__":
     parse = argparse.ArgumentParser()
     parse.add_argument("-s", default=False,  action='store_true', help="Whether save predictions")
     parse.add_argument("-q", default=False, action='store_true', help="Display video")
     parse.add_argument("--cfg", default="test", type=str)
+    parse.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
 
     cfg = parse.parse_args()
     cfg = ParserUse(cfg.cfg, "camera").add_args(cfg)
@@ -134,11 +134,14 @@ class FeatureDataset(Dataset):
         self.sample_weights = np.ones(5) if sample_weights is None else sample_weights
         self.sampler = self._get_sampler()
         self.img_features = self._get_img_features(data_features)
+        self.video_starts = np.cumsum([0] + [len(features) for features in self.img_features])
 
     def __getitem__(self, idx):
         idx = self.sample_idxs[idx]
-        # Compose aug input
-        img_features = self.img_features[idx-self.seq+1 : idx+1]  # SEQ X DIM
+        # Compose aug input, a window never crosses videos
+        video = np.searchsorted(self.video_starts, idx, side="right") - 1
+        start = idx - self.video_starts[video]
+        img_features = self.img_features[video][start-self.seq+1 : start+1]  # SEQ X DIM
         label = np.array(self.labels[idx-self.seq+1 : idx+1])
         if self.is_train:
             return img_features, label
@@ -162,9 +165,10 @@ class FeatureDataset(Dataset):
     def _get_img_features(self, data_embs):
         emb_all = []
         for data_idx in self.data_idxs:
-            emb_all.append(data_embs[data_idx])
+            features = data_embs[data_idx]
+            emb_all.append(np.stack(features, axis=0) if isinstance(features, list) else features)
 
-        return np.concatenate(emb_all, axis=0)
+        return emb_all
 
     def _check_idxs(self, idx_list):
         if isinstance(idx_list[0], int):
@@ -206,7 +210,9 @@ class VideoSample(Dataset):
     def __getitem__(self, idx):
         # Compose aug input
         data_name = self.data_names[idx]
-        img_features = np.stack(self.data_features[data_name], axis=0)
+        img_features = self.data_features[data_name]
+        if isinstance(img_features, list):  # Per-frame features of a pickled dict
+            img_features = np.stack(img_features, axis=0)
         img_names = self.data_dict[data_name]["img"]
 
         if self.get_name:
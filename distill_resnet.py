@@ -0,0 +1,191 @@
+import os
+import json
+import copy
+import pickle
+import random
+import logging
+import warnings
+warnings.filterwarnings("ignore")
+import argparse
+import numpy as np
+
+import torch
+from torch import optim
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from dataset.esd import ESDDataset
+from utils.parser import ParserUse
+from utils.util import get_device, plot_loss
+from model.resnet import ResNet, LightBackbone, load_checkpoint, load_backbone
+
+from quantize_resnet import compare_features
+from test_transnet import test_model, test_backbone
+
+
+def load_teacher(args, device):
+    """
+    ResNet50 with its classification head, from the checkpoint saved by train_resnet.
+    """
+    teacher = ResNet(has_fc=True, pretrained=False)
+    teacher.load_state_dict(load_checkpoint(args.resnet_model)["model"])
+    teacher.to(device)
+    teacher.eval()
+    for para in teacher.parameters():
+        para.requires_grad = False
+    return teacher
+
+
+def distill_loss(student_features, teacher_features, teacher_logits, head, temperature, logit_weight):
+    """
+    Regression of the pooled 2048-d teacher features, plus matching of the logits the frozen teacher head gives
+    on the student features, so the student is accurate in the directions the classifier uses.
+    :return: total, feature and logit loss.
+    """
+    loss_feature = F.mse_loss(student_features, teacher_features)
+    student_logits = head(student_features)
+    loss_logit = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                          F.softmax(teacher_logits / temperature, dim=-1), reduction="batchmean") * temperature ** 2
+    return loss_feature + logit_weight * loss_logit, loss_feature, loss_logit
+
+
+def distill_resnet(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed(args.seed)
+    logging.info("|| "*10 + "Begin distilling resnet50 to {}".format(args.student_arch))
+    device = get_device(args.device)
+
+    teacher = load_teacher(args, device)
+    student = LightBackbone(arch=args.student_arch, pretrained=True)
+    student.to(device)
+
+    optimizer = optim.Adam(params=student.parameters(), lr=args.distill_lr)
+    lr_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.distill_decay_steps, gamma=0.1)
+
+    with open(args.data_file, "rb") as f:
+        data_dict = pickle.load(f)
+    train_dataset = ESDDataset(data_dict=data_dict, data_idxs=args.train_names, is_train=True, get_name=True, class_weights=args.sample_weights)
+    val_dataset = ESDDataset(data_dict=data_dict, data_idxs=args.val_names, is_train=False, get_name=True)
+    train_loader = DataLoader(dataset=train_dataset, batch_size=args.resnet_train_bs, num_workers=args.num_worker, shuffle=True, drop_last=True)
+    val_loader = DataLoader(dataset=val_dataset, batch_size=args.resnet_train_bs, num_workers=args.num_worker, shuffle=False)
+
+    if not os.path.isdir(args.save_model):
+        os.makedirs(args.save_model)
+
+    def save_student(save_file):
+        torch.save({"model": student.state_dict(),
+                    "arch": args.student_arch,
+                    "optim": optimizer.state_dict()}, save_file)
+        args.student_model = save_file
+
+    iterations = 1
+    print("Totally {} iterations for one epoch".format(len(train_loader)))
+    best_loss = 10000
+    train_losses = []
+    val_losses = []
+    while iterations < args.distill_iterations:
+        for data in train_loader:
+            student.train()
+            imgs = data[0].to(device, non_blocking=True)
+            with torch.no_grad():
+                teacher_features = teacher.share(imgs).view(-1, 2048)
+                teacher_logits = teacher.fc(teacher_features)
+            loss, loss_feature, loss_logit = distill_loss(student(imgs), teacher_features, teacher_logits, teacher.fc,
+                                                          args.distill_temperature, args.distill_logit_weight)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            if iterations % 100 == 0:
+                logging.info("Iterations {:>10d} / {}, Loss {:>10.5f}, Feature {:>10.5f}, Logit {:>10.5f}".format(
+                    iterations, args.distill_iterations, loss.item(), loss_feature.item(), loss_logit.item()))
+                train_losses.append([iterations, loss.item()])
+
+            if iterations % 400 == 0:
+                student.eval()
+                with torch.no_grad():
+                    val_loss = []
+                    cosines = []
+                    for data in val_loader:
+                        imgs = data[0].to(device, non_blocking=True)
+                        teacher_features = teacher.share(imgs).view(-1, 2048)
+                        student_features = student(imgs)
+                        loss, _, _ = distill_loss(student_features, teacher_features, teacher.fc(teacher_features), teacher.fc,
+                                                  args.distill_temperature, args.distill_logit_weight)
+                        val_loss.append(loss.cpu().item())
+                        cosines.append(F.cosine_similarity(student_features, teacher_features, dim=1).mean().item())
+                mean_loss = sum(val_loss) / len(val_loss)
+                val_losses.append([iterations, mean_loss])
+                logging.info(">> " * 10 + "Evaluation at iterations {:>10d} is {:>10.5f}, feature cosine {:>8.5f}".format(
+                    iterations, mean_loss, sum(cosines) / len(cosines)))
+                if mean_loss < best_loss:
+                    best_loss = mean_loss
+                    save_student(os.path.join(args.save_model, "{}_{}_best.pth".format(args.student_arch, args.log_time)))
+                    logging.info("Saving model at itreation {}".format(iterations))
+
+                plot_loss(train_losses, val_losses, "./tem/{}_{}_distill_loss.pdf".format(args.log_time, args.student_arch))
+
+            lr_scheduler.step()
+            iterations += 1
+            if iterations > args.distill_iterations:
+                break
+
+    if best_loss == 10000:  # No evaluation was run
+        save_student(os.path.join(args.save_model, "{}_{}_last.pth".format(args.student_arch, args.log_time)))
+    logging.info("Student saved to {}".format(args.student_model))
+
+    return args
+
+
+def evaluate_student(args, eval_frames=1024):
+    """
+    Speed and feature accuracy of the student against ResNet50 on CPU, and phase accuracy of the temporal models
+    on the test split with features of either backbone.
+    """
+    cpu = torch.device("cpu")
+    teacher = load_backbone(args, cpu)
+    student_args = copy.deepcopy(args)
+    student_args.resnet_model = args.student_model
+    student = load_backbone(student_args, cpu)
+
+    with open(args.data_file, "rb") as f:
+        data_dict = pickle.load(f)
+    test_dataset = ESDDataset(data_dict=data_dict, data_idxs=args.test_names[:1], is_train=False)
+    test_loader = DataLoader(dataset=test_dataset, batch_size=32, num_workers=args.num_worker, shuffle=False, drop_last=False)
+    report = compare_features(teacher, student, test_loader, eval_frames)
+    report = {k.replace("fp32_", "resnet50_"): v for k, v in report.items()}
+
+    # Phase accuracy, the temporal models stay the ones trained on ResNet50 features
+    report["resnet50_accuracy"] = test_model(copy.deepcopy(args)).test_acc
+    report["student_accuracy"] = test_backbone(args, args.student_model)
+    report["arch"] = args.student_arch
+
+    for k, v in report.items():
+        logging.info("{:>24s}: {}".format(k, v))
+    report_file = os.path.join(args.getdir(), "distill_report_{}_{}.json".format(args.student_arch, args.log_time))
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Report saved to {}".format(report_file))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cfg', default='train', required=True, type=str,
+                        help='Your detailed configuration of the network')
+    parser.add_argument("-n", default="", type=str, help="Notes for paras")
+    parser.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
+    parser.add_argument("--eval", default=False, action='store_true', help="Compare speed and accuracy with ResNet50 after training")
+    parser.add_argument("--eval_only", default=False, action='store_true', help="Only evaluate the student of student_model")
+    parser.add_argument("--eval_frames", default=1024, type=int, help="Frames of a test video compared with ResNet50")
+    args = parser.parse_args()
+    args = ParserUse(args.cfg, log="distill").add_args(args)
+    args.makedir()
+
+    if not args.eval_only:
+        args = distill_resnet(args)
+    if args.eval or args.eval_only:
+        evaluate_student(args, args.eval_frames)
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import inspect
+import logging
+import argparse
+import numpy as np
+
+import cv2
+import torch
+
+from model.onnx_steps import TCNStep, TransformerStep
+from utils.guis import PhaseCom, PhaseStream
+from utils.parser import ParserUse
+from utils.preprocess import FramePreprocessor
+from utils.onnx_backend import BACKBONE_FILE, TCN_FILE, TRANSFORMER_FILE, load_onnx_models
+
+
+def export_models(phasecom, onnx_dir, opset=17):
+    """
+    Export the backbone, the streaming MS-TCN step and the streaming transformer step of an eager PhaseCom.
+    """
+    if not os.path.isdir(onnx_dir):
+        os.makedirs(onnx_dir)
+    transformer = phasecom.transformer
+    tcn_step = TCNStep(phasecom.fusion).eval()
+    transformer_step = TransformerStep(transformer).eval()
+    batch = {0: "batch"}
+    # The TorchScript exporter is the default of the pinned torch, newer versions default to the dynamo exporter
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    graphs = [
+        (phasecom.resnet, BACKBONE_FILE, (torch.randn(1, 3, 224, 224),), ["frames"], ["features"]),
+        (tcn_step, TCN_FILE,
+         (torch.randn(1, transformer.dim, 1), torch.zeros(1, tcn_step.channels, tcn_step.history_size())),
+         ["x", "history"], ["temporal", "new_history"]),
+        (transformer_step, TRANSFORMER_FILE,
+         (torch.randn(1, transformer.len_q, transformer.d_model), torch.randn(1, transformer.spa_len, transformer.dim),
+          torch.randn(1, transformer.spa_len, transformer.d_model), torch.ones(1, 1, 1)),
+         ["inputs", "frame_feas", "temporal_feas", "use_frame"], ["pred"]),
+    ]
+    for model, file_name, inputs, input_names, output_names in graphs:
+        save_file = os.path.join(onnx_dir, file_name)
+        torch.onnx.export(model, inputs, save_file, input_names=input_names, output_names=output_names,
+                          dynamic_axes={name: batch for name in input_names + output_names},
+                          opset_version=opset, **export_kwargs)
+        logging.info("Exported {}".format(save_file))
+
+
+def load_frames(video_file, num_frames):
+    """
+    Preprocessed frames of a video, or random inputs if no video is given.
+    """
+    if video_file is None:
+        return [torch.randn(1, 3, 224, 224) for _ in range(num_frames)]
+    preprocessor = FramePreprocessor(num_buffers=1)
+    player = cv2.VideoCapture(video_file)
+    frames = []
+    while len(frames) < num_frames:
+        ret, frame = player.read()
+        if not ret:
+            break
+        frames.append(preprocessor(frame, bgr=True).clone())
+    player.release()
+    return frames
+
+
+def run_stream(resnet, fusion, transformer, frames, cache_len):
+    """
+    Stream frames through the three models as PhaseCom.seg_feature does.
+    :return: features, temporal features and predictions of every frame, seconds spent in each model.
+    """
+    stream = PhaseStream(fusion, cache_len)
+    features, temporals, preds = [], [], []
+    times = np.zeros(3)
+    with torch.no_grad():
+        for inputs in frames:
+            start_time = time.time()
+            frame_feature = resnet(inputs)
+            backbone_time = time.time()
+            cat_frame_feature = stream.cache_frame_features(frame_feature).unsqueeze(0)
+            temporal_feature = fusion.forward_step(frame_feature.unsqueeze(-1), stream.fusion_state)
+            cat_temporal_feature = stream.cache_temporal_features(temporal_feature)
+            tcn_time = time.time()
+            pred = transformer.forward_last(cat_temporal_feature, cat_frame_feature)
+            end_time = time.time()
+            times += [backbone_time - start_time, tcn_time - backbone_time, end_time - tcn_time]
+            features.append(frame_feature.numpy().copy())
+            temporals.append(temporal_feature.numpy().copy())
+            preds.append(pred.numpy().copy())
+    return [np.concatenate(outputs, axis=0) for outputs in [features, temporals, preds]], times
+
+
+def check_parity(phasecom, arg, frames):
+    """
+    Compare the ONNX Runtime backend with the eager models on the same frames.
+    """
+    resnet, fusion, transformer = load_onnx_models(arg)
+    (torch_outputs, torch_times) = run_stream(phasecom.resnet, phasecom.fusion, phasecom.transformer,
+                                              frames, phasecom.frame_cache_len)
+    (onnx_outputs, onnx_times) = run_stream(resnet, fusion, transformer, frames, phasecom.frame_cache_len)
+    report = {"frames": len(frames)}
+    for name, torch_output, onnx_output in zip(["backbone", "tcn", "transformer"], torch_outputs, onnx_outputs):
+        report["{}_max_abs_diff".format(name)] = float(np.abs(torch_output - onnx_output).max())
+    report["label_agreement"] = float(np.mean(np.argmax(torch_outputs[2], axis=1) == np.argmax(onnx_outputs[2], axis=1)))
+    for name, i in zip(["backbone", "tcn", "transformer"], range(3)):
+        report["{}_torch_ms".format(name)] = torch_times[i] / len(frames) * 1000
+        report["{}_onnx_ms".format(name)] = onnx_times[i] / len(frames) * 1000
+    report["torch_fps"] = len(frames) / torch_times.sum()
+    report["onnx_fps"] = len(frames) / onnx_times.sum()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cfg', default='test', type=str, help='Your detailed configuration of the network')
+    parser.add_argument("-f", default=None, type=str, help="Video for the parity check, random inputs if not given")
+    parser.add_argument("--frames", default=300, type=int, help="Number of frames of the parity check")
+    parser.add_argument("--opset", default=17, type=int, help="ONNX opset version")
+
+    args = parser.parse_args()
+    args = ParserUse(args.cfg, log="onnx").add_args(args)
+    # Export always starts from the fp32 eager models on CPU
+    args.backend = "torch"
+    args.device = "cpu"
+    args.resnet_precision = "fp32"
+    phasecom = PhaseCom(arg=args)
+
+    export_models(phasecom, args.onnx_dir, args.opset)
+    report = check_parity(phasecom, args, load_frames(args.f, args.frames))
+    for k, v in report.items():
+        logging.info("{:>24s}: {}".format(k, v))
+    report_file = os.path.join(args.onnx_dir, "parity_report.json")
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Report saved to {}".format(report_file))
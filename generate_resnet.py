@@ -6,6 +6,7 @@ import pickle
 import random
 import argparse
 import numpy as np
+from itertools import groupby
 from tqdm import tqdm
 
 import torch
@@ -15,8 +16,10 @@ from torch.utils.data import DataLoader
 
 from dataset.esd import ESDDataset
 from utils.parser import ParserUse
+from utils.util import get_device
+from utils.feature_store import FeatureWriter
 
-from model.resnet import ResNet
+from model.resnet import load_backbone
 
 
 def generate_features(args):
@@ -25,15 +28,10 @@ def generate_features(args):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed(args.seed)
+    device = get_device(args.device)
 
     # Initialize and load the ResNet model
-    model = ResNet(out_channels=args.out_classes, has_fc=False)
-    paras = torch.load(args.resnet_model)["model"]
-    paras = {k: v for k, v in paras.items() if "fc" not in k}
-    paras = {k: v for k, v in paras.items() if "embed" not in k}
-    model.load_state_dict(paras, strict=True)
-    model.cuda()
-    model.eval()
+    model = load_backbone(args, device)
 
     # Load the data dictionary
     with open(args.data_file, "rb") as f:
@@ -56,54 +54,33 @@ def generate_features(args):
         drop_last=False
     )
 
-    feature_embs = {}
+    # Frames come in the order of emb_dataset.img_files, video after video
+    frame_counts = {name: len(data_dict[name]["img"]) for name in emb_dataset.data_idxs}
+    frame_videos = [name for name in emb_dataset.data_idxs for _ in range(frame_counts[name])]
+    args.emb_file = os.path.join(os.path.dirname(args.emb_file), f"emb_ESDSafety{args.log_time}")
+    writer = None
+    count = 0
     with torch.no_grad():
         for data in tqdm(emb_loader, total=len(emb_loader)):
-            imgs, video_names = data  # data is a tuple (imgs, video_names)
-            print("Batch Video Names:", video_names)  # Debugging
-            imgs = imgs.cuda(non_blocking=True)
-            video_names = list(video_names)  # Convert list of strings
+            imgs = data[0].to(device, non_blocking=True)
 
             # Generate features using the model
             img_features = model(imgs).cpu().numpy()
-
-            # Aggregate features per video
-            for idx, video_name in enumerate(video_names):
-                if video_name in feature_embs:
-                    feature_embs[video_name].append(img_features[idx])
-                else:
-                    feature_embs[video_name] = [img_features[idx]]
-
-    # Check if the number of features matches the number of images
-    with open(args.data_file, "rb") as f:
-        all_data = pickle.load(f)
-
-    data_names = list(feature_embs.keys())
-    for data_name in data_names:
-        if data_name not in all_data:
-            print(f"Warning: {data_name} is not present in data_dict.")
-            continue
-        if len(all_data[data_name]["img"]) != len(feature_embs[data_name]):
-            print(f"Error in data {data_name}")
-            print(f"Number of images {len(all_data[data_name]['img'])}")
-            print(f"Number of features {len(feature_embs[data_name])}")
-            raise ValueError("#imgs != #features")
-
-    # Save the aggregated features
-    args.emb_file = os.path.join(os.path.dirname(args.emb_file), f"emb_ESDSafety{args.log_time}.pkl")
+            if writer is None:
+                writer = FeatureWriter(args.emb_file, frame_counts, img_features.shape[1])
+
+            # Write the features of every video of the batch into its shard
+            for video_name, frames in groupby(frame_videos[count:count + len(img_features)]):
+                num_frames = len(list(frames))
+                writer.write(video_name, img_features[:num_frames])
+                img_features = img_features[num_frames:]
+                count += num_frames
+
+    if writer is None:
+        raise ValueError("No frames to generate features of, check data_file and the video names")
+    # Raises if the number of features does not match the number of images
+    writer.close()
     print(">>>" * 10, "Emb dataset saved to ", args.emb_file)
-    with open(args.emb_file, "wb") as f:
-        pickle.dump(feature_embs, f)
-
-    # Optionally, save features as *.npy files (commented out)
-    # if os.path.isdir(args.features_folder):
-    #     shutil.rmtree(args.features_folder)
-    # os.makedirs(args.features_folder)
-    # for data_name, features in feature_embs.items():
-    #     features = np.stack(features, axis=0)
-    #     save_file = os.path.join(args.features_folder, f"{data_name}.npy")
-    #     with open(save_file, "wb") as f:
-    #         np.save(f, features)
 
     return args
 
@@ -137,6 +114,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--cfg', default='train', required=True, type=str,
                         help='Your detailed configuration of the network')
+    parser.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
 
     args = parser.parse_args()
     args = ParserUse(args.cfg, log="generate").add_args(args)
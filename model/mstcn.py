@@ -45,6 +45,36 @@ class MultiStageModel(nn.Module):
         else:
             return out_classes
 
+    def init_stream(self, batch_size=1):
+        """
+        Create empty history buffers for streaming inference with forward_step.
+        :param batch_size: number of independent streams processed together.
+        :return: StreamState holding one buffer per dilated layer of each stage.
+        """
+        assert self.causal_conv, "Streaming inference requires causal convolutions"
+        device = self.stage1.conv_1x1.weight.device
+        buffers = [self.stage1.init_buffers(batch_size, device), self.stages.init_buffers(batch_size, device)]
+        return StreamState(buffers)
+
+    def forward_step(self, x, state):
+        """
+        Causal forward of the newest time step only, reusing the layer histories kept in state.
+        Equals the last column of forward() over all frames fed to state so far.
+        :param x: Frame feature of the newest time step  [B, 2048, 1]
+        :param state: StreamState from init_stream, updated in place.
+        :return: Output of the newest time step, same layout as forward() with a time length of 1.
+        """
+        out_classes = self.stage1.forward_step(x, state.buffers[0], state.step)
+        outputs_classes = out_classes.unsqueeze(0)
+
+        out_classes = self.stages.forward_step(F.softmax(out_classes, dim=1), state.buffers[1], state.step)
+        state.step += 1
+        if self.is_train:
+            outputs_classes = torch.cat((outputs_classes, out_classes.unsqueeze(0)), dim=0)
+            return outputs_classes
+        else:
+            return out_classes
+
     @staticmethod
     def add_model_specific_args(parser):  # pragma: no cover
         mstcn_reg_model_specific_args = parser.add_argument_group(
@@ -97,6 +127,26 @@ class SingleStageModel(nn.Module):
             out = self.conv_out_classes(out)
         return out
 
+    def init_buffers(self, batch_size, device):
+        return [layer.init_buffer(batch_size, device) for layer in self.layers]
+
+    def forward_step(self, x, buffers, step):
+        out = self.conv_1x1(x)
+        for layer, buffer in zip(self.layers, buffers):
+            out = layer.forward_step(out, buffer, step)
+        if self.is_train:
+            out = self.conv_out_classes(out)
+        return out
+
+
+class StreamState(object):
+    """
+    History buffers of the causal dilated layers for streaming inference
+    """
+    def __init__(self, buffers):
+        self.buffers = buffers
+        self.step = 0  # Number of frames seen so far
+
 
 class DilatedResidualLayer(nn.Module):
     def __init__(self,
@@ -133,6 +183,25 @@ class DilatedResidualLayer(nn.Module):
         out = self.dropout(out)
         return (x + out)
 
+    def init_buffer(self, batch_size, device):
+        # Ring buffer over the inputs covered by the dilated kernel, zeros act as the causal padding
+        in_channels = self.conv_dilated.in_channels
+        return torch.zeros((batch_size, in_channels, self.dilation * (self.kernel_size - 1) + 1), device=device)
+
+    def forward_step(self, x, buffer, step):
+        """
+        :param x: Input of the newest time step  [B, C, 1]
+        :param buffer: Ring buffer from init_buffer, updated in place.
+        :param step: Index of the newest time step in the stream.
+        """
+        size = buffer.size(2)
+        buffer[:, :, step % size] = x[:, :, 0]
+        taps = [(step - self.dilation * (self.kernel_size - 1 - k)) % size for k in range(self.kernel_size)]
+        out = F.relu(F.conv1d(buffer[:, :, taps], self.conv_dilated.weight, self.conv_dilated.bias))
+        out = self.conv_1x1(out)
+        out = self.dropout(out)
+        return (x + out)
+
 
 class SingleStageModel1(nn.Module):
     def __init__(self,
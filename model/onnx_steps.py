@@ -0,0 +1,73 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class TCNStep(nn.Module):
+    """
+    Streaming step of a causal MultiStageModel with the layer histories as explicit inputs and outputs, for export.
+    Every dilated layer keeps its last dilation * (kernel_size - 1) + 1 inputs as a shift register, all registers
+    are packed along the time axis of a single history tensor. The output equals MultiStageModel.forward_step.
+    """
+    def __init__(self, fusion):
+        """
+        :param fusion: MultiStageModel built with mstcn_causal_conv=True and is_train=False.
+        """
+        super(TCNStep, self).__init__()
+        assert fusion.causal_conv, "Streaming inference requires causal convolutions"
+        self.fusion = fusion
+        self.sizes = [layer.dilation * (layer.kernel_size - 1) + 1
+                      for stage in [fusion.stage1, fusion.stages] for layer in stage.layers]
+        self.channels = fusion.num_f_maps
+
+    def history_size(self):
+        return sum(self.sizes)
+
+    def stage_step(self, stage, x, history, offset, new_history):
+        out = stage.conv_1x1(x)
+        for layer in stage.layers:
+            size = layer.dilation * (layer.kernel_size - 1) + 1
+            register = torch.cat([history[:, :, offset + 1:offset + size], out], dim=2)
+            new_history.append(register)
+            offset += size
+            step_out = F.relu(F.conv1d(register, layer.conv_dilated.weight, layer.conv_dilated.bias,
+                                       dilation=layer.dilation))
+            out = out + layer.conv_1x1(step_out)
+        if stage.is_train:
+            out = stage.conv_out_classes(out)
+        return out, offset
+
+    def forward(self, x, history):
+        """
+        :param x: Frame feature of the newest time step  [B, 2048, 1]
+        :param history: Layer inputs of the previous time steps  [B, num_f_maps, history_size()], zeros at start.
+        :return: temporal feature of the newest time step  [B, num_f_maps, 1] and the updated history.
+        """
+        new_history = []
+        out, offset = self.stage_step(self.fusion.stage1, x, history, 0, new_history)
+        out, _ = self.stage_step(self.fusion.stages, F.softmax(out, dim=1), history, offset, new_history)
+        return out, torch.cat(new_history, dim=2)
+
+
+class TransformerStep(nn.Module):
+    """
+    Transformer.forward_last with fixed input shapes, for export.
+    Zero-padding of short windows and the choice between projected frame features and temporal features
+    for the spatial window are left to the caller, see Transformer.forward_last.
+    """
+    def __init__(self, transformer):
+        super(TransformerStep, self).__init__()
+        self.transformer = transformer
+
+    def forward(self, inputs, frame_feas, temporal_feas, use_frame):
+        """
+        :param inputs: Left zero-padded temporal window  [B, len_q, d_model]
+        :param frame_feas: Left zero-padded frame features  [B, spa_len, 2048]
+        :param temporal_feas: Temporal features of the last spa_len steps  [B, spa_len, d_model]
+        :param use_frame: 1 while the stream is shorter than spa_len, else 0  [B, 1, 1]
+        :return: prediction of the newest frame  [B, out_features]
+        """
+        # The projection has no bias, so padded rows stay zero as in forward_last
+        feas = torch.tanh(self.transformer.fc(frame_feas))
+        out_feas = use_frame * feas + (1 - use_frame) * temporal_feas
+        return self.transformer.fuse(inputs, out_feas)
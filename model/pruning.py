@@ -0,0 +1,122 @@
+import torch
+import torch.nn as nn
+
+from model.resnet import ResNet, bottlenecks
+
+
+def count_macs(model, input_size=(1, 3, 224, 224)):
+    """
+    Multiply-accumulates of the convolutions and linear layers for one input, counted on the meta device.
+    """
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        macs.append(output.numel() // output.shape[0] * kernel)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() // output.shape[0] * module.in_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+    with torch.no_grad():
+        model(torch.zeros(input_size, device="meta"))
+    for handle in handles:
+        handle.remove()
+    return sum(macs)
+
+
+def model_widths(model):
+    return [[block.conv1.out_channels, block.conv2.out_channels] for block in bottlenecks(model.share)]
+
+
+def pruned_macs(widths, out_classes=5):
+    with torch.device("meta"):
+        model = ResNet(out_channels=out_classes, has_fc=False, pretrained=False, widths=widths)
+    return count_macs(model)
+
+
+def channel_importance(model):
+    """
+    Importance of the inner channels of every bottleneck: the BatchNorm scale magnitude following the convolution,
+    divided by the mean of its layer, so channels of differently scaled layers can be ranked together.
+    :return: [bn1 importance, bn2 importance] of every bottleneck.
+    """
+    importance = []
+    for block in bottlenecks(model.share):
+        scores = []
+        for bn in [block.bn1, block.bn2]:
+            score = bn.weight.detach().abs().float()
+            scores.append(score / score.mean().clamp(min=1e-12))
+        importance.append(scores)
+    return importance
+
+
+def select_channels(importance, threshold, min_ratio):
+    """
+    :return: sorted indices of the kept channels of every bottleneck convolution, at least min_ratio of each is kept.
+    """
+    keep_idxs = []
+    for scores in importance:
+        block_idxs = []
+        for score in scores:
+            num_keep = max(int((score > threshold).sum()), int(round(min_ratio * len(score))), 1)
+            block_idxs.append(torch.sort(torch.argsort(score, descending=True)[:num_keep]).values)
+        keep_idxs.append(block_idxs)
+    return keep_idxs
+
+
+def search_channels(model, mac_budget, min_ratio=0.1, steps=30):
+    """
+    Bisection of a global importance threshold, so the pruned model fits into mac_budget with as many channels as possible.
+    :param model: trained ResNet.
+    :param mac_budget: fraction of the multiply-accumulates of model the pruned model may use.
+    :return: kept channel indices, see select_channels.
+    """
+    importance = channel_importance(model)
+    full_macs = pruned_macs(model_widths(model))
+    target = mac_budget * full_macs
+    low, high = 0., max(score.max().item() for scores in importance for score in scores)
+    # Only the min_ratio channels of every convolution are kept above the highest threshold
+    keep_idxs = select_channels(importance, high, min_ratio)
+    floor_macs = pruned_macs([[len(idx) for idx in block_idxs] for block_idxs in keep_idxs])
+    if floor_macs > target:
+        raise ValueError("A MAC budget of {} can not be reached with min_ratio {}, the smallest model keeps {:.3f} "
+                         "of the MACs".format(mac_budget, min_ratio, floor_macs / full_macs))
+    for _ in range(steps):
+        threshold = (low + high) / 2
+        idxs = select_channels(importance, threshold, min_ratio)
+        if pruned_macs([[len(idx) for idx in block_idxs] for block_idxs in idxs]) <= target:
+            keep_idxs, high = idxs, threshold
+        else:
+            low = threshold
+    return keep_idxs
+
+
+def prune_model(model, keep_idxs):
+    """
+    Copy of model with only the kept inner channels of every bottleneck, all other weights are copied unchanged.
+    :param model: ResNet on CPU.
+    :param keep_idxs: kept channel indices, see select_channels.
+    :return: pruned ResNet with widths set.
+    """
+    widths = [[len(idx) for idx in block_idxs] for block_idxs in keep_idxs]
+    pruned = ResNet(has_fc=model.has_fc, pretrained=False, widths=widths,
+                    out_channels=model.fc[-1].out_features if model.has_fc else 5)
+    paras = model.state_dict()
+    names = ["share.layer{}.{}".format(i + 1, j) for i, layer in enumerate(
+        [model.share.layer1, model.share.layer2, model.share.layer3, model.share.layer4]) for j in range(len(layer))]
+    # Bottleneck conv1 -> bn1 -> conv2 -> bn2 -> conv3, conv3 keeps its output channels for the residual sum
+    for name, (idx1, idx2) in zip(names, keep_idxs):
+        paras[name + ".conv1.weight"] = paras[name + ".conv1.weight"][idx1]
+        paras[name + ".conv2.weight"] = paras[name + ".conv2.weight"][idx2][:, idx1]
+        paras[name + ".conv3.weight"] = paras[name + ".conv3.weight"][:, idx2]
+        for bn, idx in [("bn1", idx1), ("bn2", idx2)]:
+            for key in ["weight", "bias", "running_mean", "running_var"]:
+                paras["{}.{}.{}".format(name, bn, key)] = paras["{}.{}.{}".format(name, bn, key)][idx]
+    pruned.load_state_dict(paras)
+    return pruned
@@ -3,11 +3,36 @@ import torch.nn as nn
 from torchvision import models, transforms
 from utils.augment import EFDMix
 
+def bottlenecks(resnet):
+    return [block for layer in [resnet.layer1, resnet.layer2, resnet.layer3, resnet.layer4] for block in layer]
+
+
+def set_widths(resnet, widths):
+    """
+    Replace the inner convolutions of every bottleneck of a torchvision ResNet by ones of the given widths,
+    the block inputs and outputs keep their channels.
+    :param widths: [conv1 channels, conv2 channels] of every bottleneck from layer1 to layer4.
+    """
+    for block, (width1, width2) in zip(bottlenecks(resnet), widths):
+        block.conv1 = nn.Conv2d(block.conv1.in_channels, width1, kernel_size=1, bias=False)
+        block.bn1 = nn.BatchNorm2d(width1)
+        block.conv2 = nn.Conv2d(width1, width2, kernel_size=3, stride=block.conv2.stride, padding=1, bias=False)
+        block.bn2 = nn.BatchNorm2d(width2)
+        block.conv3 = nn.Conv2d(width2, block.conv3.out_channels, kernel_size=1, bias=False)
+
+
 class ResNet(torch.nn.Module):
-    def __init__(self, out_channels=5, has_fc=True):
+    def __init__(self, out_channels=5, has_fc=True, pretrained=True, widths=None):
+        """
+        :param widths: bottleneck widths of a channel pruned ResNet50 made by prune_resnet.py, None for the full model.
+        """
         super(ResNet, self).__init__()
         self.has_fc = has_fc
-        resnet = models.resnet50(pretrained=True)
+        self.widths = widths
+        # ImageNet weights are only needed to start training, inference loads all weights from a checkpoint
+        resnet = models.resnet50(pretrained=pretrained)
+        if widths is not None:
+            set_widths(resnet, widths)
         self.share = torch.nn.Sequential()
         self.share.add_module("conv1", resnet.conv1)
         self.share.add_module("bn1", resnet.bn1)
@@ -37,3 +62,111 @@ class ResNet(torch.nn.Module):
             return self.fc(x), self.embed(x)
         else:
             return x
+
+
+class LightBackbone(torch.nn.Module):
+    """
+    Small backbone whose pooled features are projected to the 2048-d feature space of ResNet, so the temporal
+    models can consume its features unchanged. Trained to match the ResNet features by distillation.
+    """
+    def __init__(self, arch="resnet18", out_dim=2048, pretrained=True):
+        """
+        :param arch: resnet18, resnet34 or mobilenet_v3_large from torchvision.
+        """
+        super(LightBackbone, self).__init__()
+        self.arch = arch
+        if arch in ["resnet18", "resnet34"]:
+            resnet = getattr(models, arch)(pretrained=pretrained)
+            in_dim = resnet.fc.in_features
+            resnet.fc = nn.Identity()
+            self.share = resnet
+        elif arch == "mobilenet_v3_large":
+            mobilenet = models.mobilenet_v3_large(pretrained=pretrained)
+            in_dim = mobilenet.classifier[0].in_features
+            self.share = torch.nn.Sequential(mobilenet.features, mobilenet.avgpool, nn.Flatten())
+        else:
+            raise ValueError("Unknown light backbone {}".format(arch))
+        self.project = nn.Linear(in_dim, out_dim)
+
+    def forward(self, x):
+        x = x.view(-1, 3, 224, 224)
+        return self.project(self.share(x))
+
+
+class AutocastBackbone(torch.nn.Module):
+    """
+    Runs a backbone under bfloat16 autocast and returns fp32 features.
+    """
+    def __init__(self, backbone, device_type="cpu"):
+        super(AutocastBackbone, self).__init__()
+        self.backbone = backbone
+        self.device_type = device_type
+
+    def forward(self, x):
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16):
+            x = self.backbone(x)
+        return x.float()
+
+
+def load_checkpoint(model_file):
+    """
+    Checkpoint saved by train_resnet or distill_resnet, memory-mapped when its format allows it.
+    """
+    try:
+        return torch.load(model_file, map_location="cpu", mmap=True)
+    except RuntimeError:  # Checkpoints in the legacy format can not be memory-mapped
+        return torch.load(model_file, map_location="cpu")
+
+
+def build_backbone(checkpoint, out_classes):
+    """
+    Backbone without heads for the architecture stored in the checkpoint, ResNet50 unless "arch" says otherwise,
+    with the bottleneck widths of "widths" if it was channel pruned.
+    Parameters are created on the meta device and replaced by the checkpoint tensors, so nothing is
+    downloaded or randomly initialized before loading.
+    """
+    arch = checkpoint.get("arch", "resnet50")
+    with torch.device("meta"):
+        if arch == "resnet50":
+            model = ResNet(out_channels=out_classes, has_fc=False, pretrained=False, widths=checkpoint.get("widths"))
+        else:
+            model = LightBackbone(arch=arch, pretrained=False)
+    paras = {k: v for k, v in checkpoint["model"].items() if not k.startswith(("fc.", "embed."))}
+    model.load_state_dict(paras, strict=True, assign=True)
+    return model
+
+
+def load_backbone(arg, device):
+    """
+    Feature extractor for inference, selected by resnet_precision in the configs.
+    fp32 and bf16 load resnet_model, int8 loads the TorchScript model saved by quantize_resnet.py to resnet_int8_model.
+    resnet_model may also be a student checkpoint of distill_resnet.py, its features replace the ResNet50 ones.
+    :param arg: configs with out_classes, resnet_model and optionally resnet_precision, resnet_int8_model.
+    :param device: torch.device to run on, int8 is CPU only.
+    """
+    precision = arg.resnet_precision or "fp32"
+    if precision == "int8":
+        if device.type != "cpu":
+            raise ValueError("The INT8 backbone runs on CPU only, set device to cpu")
+        model = torch.jit.load(arg.resnet_int8_model, map_location="cpu")
+        model.eval()
+        return model
+    if precision not in ["fp32", "bf16"]:
+        raise ValueError("Unknown resnet_precision {}".format(precision))
+
+    model = build_backbone(load_checkpoint(arg.resnet_model), arg.out_classes)
+    model.to(device)
+    model.eval()
+    if precision == "bf16":
+        model = AutocastBackbone(model, device.type)
+    return model
+
+
+def load_light_backbone(arg, device):
+    """
+    Light backbone of the cascade, from the student checkpoint saved to cascade_model by distill_resnet.py.
+    """
+    model = build_backbone(load_checkpoint(arg.cascade_model), arg.out_classes)
+    model.to(device)
+    model.eval()
+    return model
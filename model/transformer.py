@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 import math
 
 
@@ -43,6 +44,8 @@ class MultiHeadAttention(nn.Module):
         self.ScaledDotProductAttention = ScaledDotProductAttention(self.d_k, n_heads)
         self.len_q = len_q
         self.len_k = len_k
+        # Identity affine as in the trained models, so existing checkpoints load unchanged
+        self.layer_norm = nn.LayerNorm(d_model, elementwise_affine=False)
 
     def forward(self, input_Q, input_K, input_V):
         '''
@@ -63,7 +66,7 @@ class MultiHeadAttention(nn.Module):
         context = context.transpose(1, 2).reshape(batch_size, -1,
                                                   self.n_heads * self.d_v)  # context: [batch_size, len_q, n_heads * d_v]
         output = self.fc(context)  # [batch_size, len_q, d_model]
-        return nn.LayerNorm(self.d_model).cuda()(output + residual), attn  # All batch size dimensions are reserved.
+        return self.layer_norm(output + residual), attn  # All batch size dimensions are reserved.
 
 
 class PoswiseFeedForwardNet(nn.Module):
@@ -75,6 +78,7 @@ class PoswiseFeedForwardNet(nn.Module):
             nn.Linear(d_ff, d_model, bias=False)
         )
         self.d_model = d_model
+        self.layer_norm = nn.LayerNorm(d_model, elementwise_affine=False)
 
     def forward(self, inputs):
         '''
@@ -82,7 +86,7 @@ class PoswiseFeedForwardNet(nn.Module):
         '''
         residual = inputs
         output = self.fc(inputs)
-        return nn.LayerNorm(self.d_model).cuda()(output + residual)  # [batch_size, seq_len, d_model]
+        return self.layer_norm(output + residual)  # [batch_size, seq_len, d_model]
 
 
 class EncoderLayer(nn.Module):
@@ -170,8 +174,8 @@ class Decoder(nn.Module):
 class Transformer2_3_1(nn.Module):
     def __init__(self, d_model, d_ff, d_k, d_v, n_layers, n_heads, len_q):
         super(Transformer2_3_1, self).__init__()
-        self.encoder = Encoder(d_model, d_ff, d_k, d_v, n_layers, n_heads, len_q).cuda()
-        self.decoder = Decoder(d_model, d_ff, d_k, d_v, 1, n_heads, len_q).cuda()
+        self.encoder = Encoder(d_model, d_ff, d_k, d_v, n_layers, n_heads, len_q)
+        self.decoder = Decoder(d_model, d_ff, d_k, d_v, 1, n_heads, len_q)
 
     def forward(self, enc_inputs, dec_inputs):
         '''
@@ -195,6 +199,7 @@ class Transformer(nn.Module):
         self.num_classes = out_features  # 7
         self.len_q = len_q
         self.d_model = out_features if d_model is None else d_model
+        self.spa_len = 10
 
         self.spatial_encoder = EncoderLayer(self.d_model, mstcn_f_maps, mstcn_f_maps, mstcn_f_maps, 8, 5)
         self.transformer = Transformer2_3_1(d_model=self.d_model, d_ff=mstcn_f_maps, d_k=mstcn_f_maps,
@@ -216,30 +221,53 @@ class Transformer(nn.Module):
         :return: frame-wise predictions.
         """
         out_features = x.transpose(1, 2)  # [1, 512, 5]
-        bs = out_features.size(0)  # 1
-        inputs = []
-        for i in range(out_features.size(1)):
-            if i<self.len_q-1:
-                input0 = torch.zeros((bs, self.len_q-1-i, self.d_model)).cuda()
-                input0 = torch.cat([input0, out_features[:, 0:i+1]], dim=1)
-            else:
-                input0 = out_features[:, i-self.len_q+1:i+1]  # Collect all previous features
-            inputs.append(input0)
-        inputs = torch.stack(inputs, dim=0).squeeze(1)
-
-        feas = torch.tanh(self.fc(long_feature))  # .transpose(0, 1))  # Project the input to desired dimension
-        out_feas = []
-        spa_len = 10
-        for i in range(feas.size(1)):
-            if i < spa_len - 1:
-                input0 = torch.zeros((bs, spa_len - 1 - i, 32)).cuda()
-                input0 = torch.cat([input0, feas[:, 0:i + 1]], dim=1)
-            else:
-                input0 = out_features[:, i - spa_len + 1:i + 1]  # Collect all previous features
-            out_feas.append(input0)
-        out_feas = torch.stack(out_feas, dim=0).squeeze(1)
+        # Left-padded sliding windows ending at every frame, built as strided views instead of per-frame loops
+        inputs = self.sliding_windows(out_features, self.len_q)  # [512, 30, 5]
+
+        # Projected spatial features only fill the windows of the first spa_len-1 frames,
+        # later windows collect the previous temporal features
+        spa_len = self.spa_len
+        num_head = min(out_features.size(1), spa_len - 1)
+        feas = torch.tanh(self.fc(long_feature[:, :num_head]))  # Project the input to desired dimension
+        out_feas = torch.cat([self.sliding_windows(feas, spa_len),
+                              self.sliding_windows(out_features, spa_len)[num_head:]], dim=0)
         # inputs: [512, 30, 5],
         # feas: [512, 1, 5]  --> Spatial features
+        return self.fuse(inputs, out_feas)
+
+    def forward_last(self, x, long_feature):
+        """
+        Prediction of the newest frame only, equal to forward(x, long_feature)[-1] for a single video.
+        Only the last len_q steps of x and, for windows shorter than spa_len, long_feature are used.
+        :param x: Shifted frame-wise predictions  [B, 5, N]
+        :param long_feature: Long-range spatial features  [B, N, 2048]
+        :return: prediction of the newest frame  [B, out_features].
+        """
+        out_features = x.transpose(1, 2)  # [B, N, 5]
+        bs, seq_len = out_features.size(0), out_features.size(1)
+        inputs = out_features[:, -self.len_q:]
+        if seq_len < self.len_q:
+            inputs = torch.cat([inputs.new_zeros((bs, self.len_q - seq_len, self.d_model)), inputs], dim=1)
+
+        if seq_len < self.spa_len:
+            feas = torch.tanh(self.fc(long_feature))  # Projected spatial features are only used for the first frames
+            out_feas = torch.cat([feas.new_zeros((bs, self.spa_len - seq_len, self.d_model)), feas], dim=1)
+        else:
+            out_feas = out_features[:, -self.spa_len:]
+        return self.fuse(inputs, out_feas)
+
+    @staticmethod
+    def sliding_windows(features, win_len):
+        """
+        :param features: frame-wise features  [B, N, D]
+        :param win_len: length of the windows
+        :return: zero-padded windows ending at every frame  [B x N, win_len, D]
+        """
+        padded = F.pad(features, (0, 0, win_len - 1, 0))
+        windows = padded.unfold(1, win_len, 1)  # [B, N, D, win_len]
+        return windows.transpose(2, 3).reshape(-1, win_len, features.size(2))
+
+    def fuse(self, inputs, out_feas):
         out_feas, _ = self.spatial_encoder(out_feas)
         output = self.transformer(inputs, out_feas)  # Feature fusion between  temporal and spatial features
         output = self.out(output)
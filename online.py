@@ -16,7 +16,15 @@ from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt, QThread
 from PyQt5.QtWidgets import QMainWindow, QFileDialog, QWidget, QPushButton, QLabel, QLineEdit, QVBoxLayout, QHBoxLayout, QStatusBar, QMessageBox
 
 from utils.parser import ParserUse
-from utils.guis import PhaseCom
+from utils.phase_server import PhaseServer
+from utils.pipeline import PhasePipeline
+from utils.capture import FrameSource
+from utils.latency import LatencyMonitor
+from utils.recorder import VideoRecorder
+from utils.display import DisplayWorker
+from utils.overlay import TextOverlay
+from utils.guis import TEXT_ORIGINS
+from utils.session_log import SessionLog, LOG_COLUMNS, export_csv
 from utils.report_tools import generate_report, get_meta
 
 warnings.filterwarnings("ignore")
@@ -33,11 +41,21 @@ logging.basicConfig(
 
 class VideoThread(QThread):
     change_pixmap_signal = pyqtSignal(np.ndarray)
-    process_img_signal = pyqtSignal(np.ndarray, int)
 
-    def __init__(self, video_path=None):
+    def __init__(self, video_path=None, frame_handler=None, display_ratio=1, infer_ratio=1, monitor=None):
+        """
+        :param video_path: video file to play.
+        :param frame_handler: called in this thread with (frame, frame_idx) for every infer_ratio-th frame.
+        :param display_ratio: every display_ratio-th frame is displayed.
+        :param infer_ratio: every infer_ratio-th frame is passed to frame_handler, frames in between are not decoded.
+        :param monitor: LatencyMonitor receiving the decode times.
+        """
         super().__init__()
         self._run_flag = True
+        self.frame_handler = frame_handler
+        self.display_ratio = display_ratio
+        self.infer_ratio = infer_ratio
+        self.monitor = monitor
         if not video_path:
             logging.error("No video path provided")
             return
@@ -48,17 +66,24 @@ class VideoThread(QThread):
 
     def run(self):
         try:
-            cap = cv2.VideoCapture(self.video_path)
-            frame_idx = 0
-            
+            cap = FrameSource(self.video_path, self.display_ratio, self.infer_ratio)
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            frame_interval = 1 / fps if fps > 0 else 1 / 30
+            next_time = time.time()
+
             while self._run_flag and cap.isOpened():
-                ret, cv_img = cap.read()
+                decode_time = time.time()
+                ret, cv_img, frame_idx, display, infer = cap.read()
                 if ret:
-                    frame_idx += 1
-                    self.change_pixmap_signal.emit(cv_img)
-                    self.process_img_signal.emit(cv_img, frame_idx)
-                    # Control playback speed
-                    time.sleep(1/30)  # Adjust for smoother playback
+                    if self.monitor is not None and cv_img is not None:
+                        self.monitor.record("decode", time.time() - decode_time)
+                    if display:
+                        self.change_pixmap_signal.emit(cv_img)
+                    if infer and self.frame_handler is not None:
+                        self.frame_handler(cv_img, frame_idx)
+                    # Control playback speed at the source frame rate, independent of the model latency
+                    next_time += frame_interval
+                    time.sleep(max(0, next_time - time.time()))
                 else:
                     break
                     
@@ -71,10 +96,12 @@ class VideoThread(QThread):
         self.wait()
 
 class Ui_iPhaser(QMainWindow):
+    prediction_signal = pyqtSignal(str, str, int, float)
+
     def __init__(self):
         super(Ui_iPhaser, self).__init__()
 
-    def setupUi(self, cfg):
+    def setupUi(self, cfg, server=None):
         self.setObjectName("iPhaser")
         self.resize(1300, 930)
         self.centralwidget = QWidget(self)
@@ -94,21 +121,29 @@ class Ui_iPhaser(QMainWindow):
         
         # Initialize other parameters
         self.down_ratio = cfg.down_ratio
+        self.display_ratio = cfg.display_ratio or 1
+        self.record_segment = cfg.record_segment or 600
+        self.record_queue = cfg.record_queue or 64
         self.start_time = "--:--:--"
         self.trainee_name = "--"
-        self.manual_set = "--"
+        self.manual = ("--", 0.)  # Manual phase and the time it expires, replaced as a whole by keyPressEvent
         self.date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S.%f")
         self.fps = 0
         self.pred = "--"
-        self.log_data = []
         
-        # Initialize phase segmentation
-        self.phaseseg = PhaseCom(arg=cfg)
+        # Initialize phase segmentation, beds started together share the models of one server
+        if server is None:
+            server = PhaseServer(cfg, max_batch=cfg.server_batch, max_wait=cfg.server_wait)
+        self.latency = LatencyMonitor(log_interval=cfg.latency_log_interval or 60)
+        self.status_time = 0
+        self.phaseseg = server.new_client(self.latency)
+        self.pipeline = PhasePipeline(self.phaseseg, self.emit_prediction, self.latency)
+        self.prediction_signal.connect(self.update_prediction)
         
         # Initialize status
         self.init_status()
-        self.MANUAL_FRAMES = self.stream_fps * cfg.manual_set_fps_ratio
-        self.manual_frame = 0
+        # Manual settings hold for manual_set_fps_ratio seconds
+        self.MANUAL_SECONDS = cfg.manual_set_fps_ratio
 
         # Main layout
         main_layout = QVBoxLayout(self.centralwidget)
@@ -164,6 +199,14 @@ class Ui_iPhaser(QMainWindow):
         self.DisplayVideo.setAlignment(QtCore.Qt.AlignCenter)
         self.DisplayVideo.setObjectName("DisplayVideo")
         main_layout.addWidget(self.DisplayVideo)
+        # Frames are scaled and annotated in the display worker, the GUI thread swaps pixmaps at the screen refresh rate
+        self.display = DisplayWorker(self.disply_width, self.display_height, self.update_image, monitor=self.latency)
+        # Recorded frames keep the source resolution and have their own text cache
+        self.record_overlay = TextOverlay(TEXT_ORIGINS)
+        refresh_rate = QtWidgets.QApplication.primaryScreen().refreshRate() or 60
+        self.display_timer = QtCore.QTimer(self)
+        self.display_timer.timeout.connect(self.repaint_display)
+        self.display_timer.start(max(1, int(1000 / refresh_rate)))
 
         # --- Information and Control Layout ---
         info_control_layout = QHBoxLayout()
@@ -275,9 +318,8 @@ class Ui_iPhaser(QMainWindow):
             cap.release()
 
         # Initialize video thread with video path
-        self.thread = VideoThread(self.video_path)
-        self.thread.change_pixmap_signal.connect(self.update_image)
-        self.thread.process_img_signal.connect(self.process_img)
+        self.thread = VideoThread(self.video_path, self.process_img, self.display_ratio, self.down_ratio, self.latency)
+        self.thread.change_pixmap_signal.connect(self.show_frame, Qt.DirectConnection)
         self.thread.start()
 
     def init_status(self):
@@ -324,9 +366,12 @@ class Ui_iPhaser(QMainWindow):
             # Initialize processing status
             self.WORKING = True
             self.INIT = True
-            self.log_data = []
-            self.manual_frame = 0
-            self.manual_set = "--"
+            self.latency.reset()
+            if self.phaseseg.stream.detector is not None:
+                self.phaseseg.stream.detector.reset()
+            if self.phaseseg.stream.gate is not None:
+                self.phaseseg.stream.gate.reset()
+            self.manual = ("--", 0.)
             
             # Get input values
             self.trainee_name = self.TraineeName.text() or "unnamed"
@@ -342,20 +387,25 @@ class Ui_iPhaser(QMainWindow):
             # Create log and video files
             base_name = f"{self.case_name}_{self.trainee_name}_{timestamp}"
             self.log_file = os.path.join(self.save_folder, f"{base_name}.csv")
+            # Rows are streamed to disk during the session and exported to the csv log on stop
+            self.session_log = SessionLog(os.path.join(self.save_folder, f"{base_name}.session"),
+                                          LOG_COLUMNS + ["Latency", "P50", "P95", "P99"])
             video_path = os.path.join(self.save_folder, f"{base_name}.avi")
             
-            # Initialize video writer
-            self.output_video = cv2.VideoWriter(
+            # Record the displayed frames at the source resolution, encoded in a separate thread
+            self.output_video = VideoRecorder(
                 video_path,
-                self.CODEC,
-                max(1, self.stream_fps),
-                (self.FRAME_WIDTH, self.FRAME_HEIGHT)
+                max(1, self.stream_fps // self.display_ratio),
+                codec=self.CODEC,
+                segment_seconds=self.record_segment,
+                max_queue=self.record_queue,
+                rgb=True,
+                monitor=self.latency
             )
 
             # Start video processing
-            self.thread = VideoThread(self.video_path)
-            self.thread.change_pixmap_signal.connect(self.update_image)
-            self.thread.process_img_signal.connect(self.process_img)
+            self.thread = VideoThread(self.video_path, self.process_img, self.display_ratio, self.down_ratio, self.latency)
+            self.thread.change_pixmap_signal.connect(self.show_frame, Qt.DirectConnection)
             self.thread.start()
 
             # Update UI
@@ -383,9 +433,16 @@ class Ui_iPhaser(QMainWindow):
             if hasattr(self, 'thread'):
                 self.thread.stop()
             if hasattr(self, 'output_video'):
-                self.output_video.release()
-            if hasattr(self, 'log_data') and self.log_data:
+                self.output_video.close()
+                del self.output_video
+            if hasattr(self, 'session_log'):
                 self.save_log_data()
+                del self.session_log
+            self.latency.log(force=True)
+            if self.phaseseg.stream.detector is not None:
+                logging.info("Backbone features reused for {:.1%} of the frames".format(self.phaseseg.stream.detector.reuse_rate))
+            if self.phaseseg.stream.gate is not None:
+                logging.info("ResNet50 ran on {:.1%} of the cascade frames".format(self.phaseseg.stream.gate.escalation_rate))
             
             # Reset UI
             self.label.setText("--:--:--")
@@ -471,30 +528,13 @@ class Ui_iPhaser(QMainWindow):
         self.ActionTakeOver.setEnabled(False)
 
     def save_log_data(self):
-        if not self.log_data:
-            return
-            
         try:
-            datas = zip(*self.log_data)
-            data_dict = {}
-            names = ["Time", "Frame", "Trainee", "Trainer", "Bed", "Status", "FPS", "Prediction", "Correction"]
-            
-            for name, data in zip(names, datas):
-                # Convert all data to strings
-                data_dict[name] = [str(x) if x is not None else "--" for x in data]
-                
-            pd_log = pd.DataFrame.from_dict(data_dict)
-            
-            # Handle predictions and corrections
-            preds = pd_log["Prediction"].tolist()
-            correcs = pd_log["Correction"].tolist()
-            combines = [corr if corr != "--" else pred for pred, corr in zip(preds, correcs)]
-            pd_log["Combine"] = combines
-            
-            # Save to file
+            self.session_log.close()
+            # Same file name as the logs written before streaming, the latency columns follow Combine
             current_time = datetime.now().strftime("%H-%M-%S")
             save_path = self.log_file.replace(".csv", f"_{current_time}.csv")
-            pd_log.to_csv(save_path, index=False, header=True)
+            export_csv(self.session_log.log_file, save_path)
+            os.remove(self.session_log.log_file)
             
         except Exception as e:
             logging.error(f"Error saving log data: {e}")
@@ -519,114 +559,127 @@ class Ui_iPhaser(QMainWindow):
             return 1920, 1080, 30  # Default values
 
     def process_img(self, cv_img, frame_idx):
+        # Called from the capture thread for every down_ratio-th frame, the frame is only handed over to the inference pipeline
         if self.WORKING:
-            try:
-                # Process frame
-                rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-                
-                if frame_idx % self.down_ratio == 0:
-                    self.date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S.%f")
-                    start_time = time.time()
-                    
-                    # Get model prediction
-                    self.pred = self.phaseseg.seg_frame(rgb_image)
-                    end_time = time.time()
-                    self.fps = 1/np.round(end_time - start_time, 3)
+            date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S.%f")
+            self.pipeline.put(cv_img, frame_idx, date_time)
 
-                    # Update phase display
-                    self.phase_display.setText(f"Phase: {self.pred}")
-                    
-                    # Color-code based on phase
-                    phase_colors = {
-                        'idle': 'lightblue',
-                        'marking': 'yellow',
-                        'injection': 'orange', 
-                        'dissection': 'red'
-                    }
-                    color = phase_colors.get(self.pred, 'white')
-                    self.phase_display.setStyleSheet(f"""
-                        QLabel {{
-                            background-color: black;
-                            color: {color};
-                            padding: 5px;
-                            font-size: 16px;
-                            font-weight: bold;
-                        }}
-                    """)
-
-                    # Log data
-                    self.log_data.append([
-                        self.date_time,
-                        str(frame_idx).zfill(7),
-                        self.trainee_name,
-                        self.trainer_name,
-                        self.bed_name,
-                        self.STATUS,
-                        f"{self.fps:>7.4f}",
-                        self.pred,
-                        self.manual_set
-                    ])
-                
-            except Exception as e:
-                logging.error(f"Error in process_img: {e}")
+    def emit_prediction(self, pred, date_time, frame_idx, latency):
+        # Called from the inference thread, the GUI is only updated in update_prediction
+        self.prediction_signal.emit(pred, date_time, frame_idx, latency)
+
+    def update_prediction(self, pred, date_time, frame_idx, latency):
+        if not self.WORKING:
+            return
+        try:
+            self.pred = pred
+            self.fps = 1 / max(latency, 1e-3)
+
+            # Update phase display
+            self.phase_display.setText(f"Phase: {self.pred}")
+
+            # Color-code based on phase
+            phase_colors = {
+                'idle': 'lightblue',
+                'marking': 'yellow',
+                'injection': 'orange',
+                'dissection': 'red'
+            }
+            color = phase_colors.get(self.pred, 'white')
+            self.phase_display.setStyleSheet(f"""
+                QLabel {{
+                    background-color: black;
+                    color: {color};
+                    padding: 5px;
+                    font-size: 16px;
+                    font-weight: bold;
+                }}
+            """)
+
+            # Log data, with the end-to-end latency of the frame and its running percentiles in ms
+            percentiles = self.latency.percentiles("total") or [latency] * 3
+            self.session_log.append([
+                date_time,
+                str(frame_idx).zfill(7),
+                self.trainee_name,
+                self.trainer_name,
+                self.bed_name,
+                self.STATUS,
+                f"{self.fps:>7.4f}",
+                self.pred,
+                self.manual_phase()
+            ] + [f"{value * 1000:.1f}" for value in [latency] + percentiles])
+
+            # Stage percentiles in the status bar once per second and periodically in the log
+            if time.time() - self.status_time >= 1:
+                self.status_time = time.time()
+                self.statusbar.showMessage("p50/p95/p99 [ms]  " + self.latency.summary())
+            self.latency.log()
+
+        except Exception as e:
+            logging.error(f"Error in update_prediction: {e}")
 
     def keyPressEvent(self, e):
+        manual_keys = {"a": "idle", "s": "marking", "d": "injection", "f": "dissection"}
         pressed_key = e.text()
-        if pressed_key == "a":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "idle"
-        elif pressed_key == "s":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "marking"
-        elif pressed_key == "d":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "injection"
-        elif pressed_key == "f":
-            self.manual_frame = self.MANUAL_FRAMES
-            self.manual_set = "dissection"
-
-    def update_image(self, cv_img):
-        """Convert from an opencv image to QPixmap"""
+        if pressed_key in manual_keys:
+            self.manual = (manual_keys[pressed_key], time.time() + self.MANUAL_SECONDS)
+
+    def manual_phase(self):
+        """Manual phase set by the keys, "--" once it expired"""
+        phase, expire_time = self.manual
+        return phase if time.time() < expire_time else "--"
+
+    def draw_text(self, rgb_image, overlay=None):
+        """Draw the time, phase and trainee on an RGB frame in place, a manual phase overrides the prediction"""
+        manual = self.manual_phase()
+        pred = manual if manual != "--" else self.pred
+        overlay_time = time.time()
+        self.phaseseg.add_text(
+            datetime.now().strftime("%d/%m/%Y-%H:%M:%S"),
+            pred,
+            self.trainee_name,
+            rgb_image,
+            overlay
+        )
+        self.latency.record("overlay", time.time() - overlay_time)
+
+    def show_frame(self, cv_img):
+        """Record a displayed frame and hand it over to the display worker, called in the capture thread"""
+        try:
+            if self.WORKING and hasattr(self, 'output_video'):
+                # Converting makes the recorder's own full-resolution copy, the source frame goes on to the display
+                rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+                if self.INIT:
+                    self.draw_text(rgb_image, self.record_overlay)
+                self.output_video.write(rgb_image)
+        except Exception as e:
+            logging.error(f"Error in show_frame: {e}")
+        self.display.put(cv_img)
+
+    def update_image(self, rgb_image):
+        """Draw the overlay on a display-sized RGB frame, called in the display worker thread"""
         try:
-            rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-            
-            # Handle manual frame countdown
-            self.manual_frame = self.manual_frame - 1
-            if self.manual_frame <= 0:
-                self.manual_frame = 0
-                self.manual_set = "--"
-                
-            # Add overlay text if initialized
             if self.INIT:
-                self.date_time = datetime.now().strftime("%d/%m/%Y-%H:%M:%S")
-                if self.manual_frame > 0:
-                    self.pred = self.manual_set
-                rgb_image = self.phaseseg.add_text(
-                    self.date_time, 
-                    self.pred,
-                    self.trainee_name,
-                    rgb_image
-                )
-
-            # Convert to Qt format and display
-            h, w, ch = rgb_image.shape
-            bytes_per_line = ch * w
-            convert_to_Qt_format = QtGui.QImage(
-                rgb_image.data, 
-                w, h, 
-                bytes_per_line,
-                QtGui.QImage.Format_RGB888
-            )
-            p = convert_to_Qt_format.scaled(
-                self.disply_width, 
-                self.display_height, 
-                Qt.KeepAspectRatio
-            )
-            self.DisplayVideo.setPixmap(QPixmap.fromImage(p))
-            
+                self.draw_text(rgb_image)
         except Exception as e:
             logging.error(f"Error in update_image: {e}")
 
+    def repaint_display(self):
+        """Show the newest prepared frame, called by the display timer"""
+        rgb_image = self.display.latest()
+        if rgb_image is None:
+            return
+        h, w, ch = rgb_image.shape
+        bytes_per_line = ch * w
+        convert_to_Qt_format = QtGui.QImage(
+            rgb_image.data, 
+            w, h, 
+            bytes_per_line,
+            QtGui.QImage.Format_RGB888
+        )
+        self.DisplayVideo.setPixmap(QPixmap.fromImage(convert_to_Qt_format))
+
     def click_choose_video(self):
         fileName_choose, filetype = QFileDialog.getOpenFileName(
             self,
@@ -640,6 +693,9 @@ class Ui_iPhaser(QMainWindow):
 
     def closeEvent(self, event):
         self.click_stop()
+        self.display_timer.stop()
+        self.display.close()
+        self.pipeline.close()
         event.accept()
 
 if not os.path.exists("./configs/report_template.png"):
@@ -654,7 +710,9 @@ if __name__ == "__main__":
     parse.add_argument("-s", default=False, action='store_true', help="Whether save predictions")
     parse.add_argument("-q", default=False, action='store_true', help="Display video")
     parse.add_argument("--cfg", default="test", type=str)
+    parse.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
     parse.add_argument("--video_path", type=str, required=False, help="Path to input video file")
+    parse.add_argument("--beds", default=1, type=int, help="Number of beds served by one copy of the models")
 
     cfg = parse.parse_args()
     cfg = ParserUse(cfg.cfg, "camera").add_args(cfg)
@@ -664,8 +722,14 @@ if __name__ == "__main__":
 
     app = QtWidgets.QApplication(sys.argv)
     app.setStyle('Fusion')
-    ui = Ui_iPhaser()
-    ui.setupUi(cfg)
-    ui.show()
-    sys.exit(app.exec_())
+    server = PhaseServer(cfg, max_batch=cfg.server_batch, max_wait=cfg.server_wait)
+    uis = []
+    for bed_idx in range(cfg.beds):
+        ui = Ui_iPhaser()
+        ui.setupUi(cfg, server)
+        ui.show()
+        uis.append(ui)
+    ret = app.exec_()
+    server.close()
+    sys.exit(ret)
 
@@ -0,0 +1,108 @@
+import os
+import json
+import copy
+import pickle
+import random
+import logging
+import warnings
+warnings.filterwarnings("ignore")
+import argparse
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader
+
+from dataset.esd import ESDDataset
+from utils.parser import ParserUse
+from model.resnet import ResNet, load_checkpoint, load_backbone
+from model.pruning import search_channels, prune_model, pruned_macs
+
+from quantize_resnet import compare_features
+from train_resnet_con import train_resnet
+from test_transnet import test_model, test_backbone
+
+
+def prune_resnet(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    logging.info("|| "*10 + "Begin pruning resnet50 to {} of its MACs".format(args.prune_flops))
+
+    model = ResNet(has_fc=True, pretrained=False)
+    model.load_state_dict(load_checkpoint(args.resnet_model)["model"])
+    model.eval()
+    keep_idxs = search_channels(model, args.prune_flops, args.prune_min_channels)
+    pruned = prune_model(model, keep_idxs)
+    logging.info("Bottleneck widths {}".format(pruned.widths))
+    logging.info("GMACs {:.3f} -> {:.3f}".format(pruned_macs(None) / 1e9, pruned_macs(pruned.widths) / 1e9))
+
+    if not os.path.isdir(args.save_model):
+        os.makedirs(args.save_model)
+    save_file = os.path.join(args.save_model, "resnet50_pruned_{}.pth".format(args.log_time))
+    torch.save({"model": pruned.state_dict(),
+                "widths": pruned.widths}, save_file)
+    args.pruned_model = save_file
+    logging.info("Pruned model saved to {}".format(save_file))
+
+    if args.prune_iterations:
+        # Fine-tuning continues from the pruned checkpoint with the losses of the ResNet50 training
+        tune_args = copy.deepcopy(args)
+        tune_args.start_iter = save_file
+        tune_args.resnet_iterations = args.prune_iterations
+        tune_args.resnet_decay_steps = args.prune_decay_steps
+        args.pruned_model = train_resnet(tune_args).resnet_model
+        logging.info("Fine-tuned model saved to {}".format(args.pruned_model))
+    return args
+
+
+def evaluate_pruned(args, eval_frames=1024):
+    """
+    MACs, CPU speed and feature accuracy of the pruned model against ResNet50, and phase accuracy of the temporal
+    models on the test split with features of either backbone.
+    """
+    cpu = torch.device("cpu")
+    full = load_backbone(args, cpu)
+    pruned_args = copy.deepcopy(args)
+    pruned_args.resnet_model = args.pruned_model
+    pruned = load_backbone(pruned_args, cpu)
+
+    with open(args.data_file, "rb") as f:
+        data_dict = pickle.load(f)
+    test_dataset = ESDDataset(data_dict=data_dict, data_idxs=args.test_names[:1], is_train=False)
+    test_loader = DataLoader(dataset=test_dataset, batch_size=32, num_workers=args.num_worker, shuffle=False, drop_last=False)
+    report = compare_features(full, pruned, test_loader, eval_frames)
+    report = {k.replace("fp32_", "resnet50_"): v for k, v in report.items()}
+    report["resnet50_gmacs"] = pruned_macs(None) / 1e9
+    widths = load_checkpoint(args.pruned_model)["widths"]
+    report["gmacs"] = pruned_macs(widths) / 1e9
+
+    # Phase accuracy, the temporal models stay the ones trained on ResNet50 features
+    report["resnet50_accuracy"] = test_model(copy.deepcopy(args)).test_acc
+    report["pruned_accuracy"] = test_backbone(args, args.pruned_model)
+    report["widths"] = widths
+
+    for k, v in report.items():
+        logging.info("{:>24s}: {}".format(k, v))
+    report_file = os.path.join(args.getdir(), "prune_report_{}.json".format(args.log_time))
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Report saved to {}".format(report_file))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cfg', default='train', required=True, type=str,
+                        help='Your detailed configuration of the network')
+    parser.add_argument("-n", default="", type=str, help="Notes for paras")
+    parser.add_argument("--eval", default=False, action='store_true', help="Compare speed and accuracy with ResNet50 after pruning")
+    parser.add_argument("--eval_only", default=False, action='store_true', help="Only evaluate the model of pruned_model")
+    parser.add_argument("--eval_frames", default=1024, type=int, help="Frames of a test video compared with ResNet50")
+    args = parser.parse_args()
+    args = ParserUse(args.cfg, log="prune").add_args(args)
+    args.makedir()
+
+    if not args.eval_only:
+        args = prune_resnet(args)
+    if args.eval or args.eval_only:
+        evaluate_pruned(args, args.eval_frames)
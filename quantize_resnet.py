@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import pickle
+import random
+import logging
+import warnings
+warnings.filterwarnings("ignore")
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from dataset.esd import ESDDataset
+from utils.parser import ParserUse
+from model.resnet import AutocastBackbone, load_backbone
+
+
+def quantize_int8(model, loader, calib_batches):
+    """
+    Post-training static INT8 quantization of the backbone with FX graph mode.
+    :param model: fp32 ResNet without fc on CPU.
+    :param loader: frames used to calibrate the activation ranges.
+    :param calib_batches: number of batches of the calibration pass.
+    :return: quantized TorchScript model.
+    """
+    engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+    torch.backends.quantized.engine = engine
+    example_inputs = (torch.randn(1, 3, 224, 224),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+    with torch.no_grad():
+        for i, data in enumerate(tqdm(loader, total=min(calib_batches, len(loader)))):
+            if i >= calib_batches:
+                break
+            prepared(data[0])
+    quantized = convert_fx(prepared)
+    quantized = torch.jit.freeze(torch.jit.trace(quantized, example_inputs).eval())
+    return quantized
+
+
+def extract_features(model, loader, max_frames):
+    features = []
+    num_frames = 0
+    with torch.no_grad():
+        for data in loader:
+            features.append(model(data[0]))
+            num_frames += len(data[0])
+            if num_frames >= max_frames:
+                break
+    return torch.cat(features, dim=0)[:max_frames]
+
+
+def frame_latency(model, frames, repeat=20):
+    """
+    Seconds per frame at batch size one, as in online inference.
+    """
+    with torch.no_grad():
+        model(frames[:1])  # Warm up
+        start_time = time.time()
+        for i in range(repeat):
+            model(frames[i % len(frames)].unsqueeze(0))
+    return (time.time() - start_time) / repeat
+
+
+def compare_features(ref_model, model, loader, max_frames):
+    """
+    Accuracy of a reduced precision backbone against the fp32 features of the same frames.
+    """
+    ref_features = extract_features(ref_model, loader, max_frames)
+    features = extract_features(model, loader, max_frames)
+    cosine = F.cosine_similarity(features, ref_features, dim=1)
+    rel_error = (features - ref_features).norm(dim=1) / ref_features.norm(dim=1).clamp(min=1e-8)
+    frames = next(iter(loader))[0]
+    fp32_latency = frame_latency(ref_model, frames)
+    latency = frame_latency(model, frames)
+    return {"frames": len(ref_features),
+            "cosine_mean": cosine.mean().item(),
+            "cosine_min": cosine.min().item(),
+            "rel_error_mean": rel_error.mean().item(),
+            "rel_error_max": rel_error.max().item(),
+            "max_abs_error": (features - ref_features).abs().max().item(),
+            "fp32_ms_per_frame": fp32_latency * 1000,
+            "ms_per_frame": latency * 1000,
+            "speedup": fp32_latency / latency}
+
+
+def quantize_resnet(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device("cpu")
+    precision = args.precision
+
+    args.resnet_precision = "fp32"
+    model = load_backbone(args, device)
+
+    with open(args.data_file, "rb") as f:
+        data_dict = pickle.load(f)
+    # Features are compared on one held-out video
+    test_dataset = ESDDataset(data_dict=data_dict, data_idxs=args.test_names[:1], is_train=False)
+    test_loader = DataLoader(dataset=test_dataset, batch_size=args.calib_bs, num_workers=args.num_worker, shuffle=False, drop_last=False)
+
+    if precision == "int8":
+        calib_dataset = ESDDataset(data_dict=data_dict, data_idxs=args.train_names, is_train=False)
+        calib_loader = DataLoader(dataset=calib_dataset, batch_size=args.calib_bs, num_workers=args.num_worker, shuffle=True, drop_last=False)
+        logging.info("Calibrating on {} batches of {} frames".format(args.calib_batches, args.calib_bs))
+        quant_model = quantize_int8(model, calib_loader, args.calib_batches)
+        if not os.path.isdir(os.path.dirname(os.path.abspath(args.resnet_int8_model))):
+            os.makedirs(os.path.dirname(os.path.abspath(args.resnet_int8_model)))
+        torch.jit.save(quant_model, args.resnet_int8_model)
+        logging.info("INT8 backbone saved to {}".format(args.resnet_int8_model))
+    elif precision == "bf16":
+        quant_model = AutocastBackbone(model, device.type)
+    else:
+        raise ValueError("Unknown precision {}".format(precision))
+
+    report = compare_features(model, quant_model, test_loader, args.eval_frames)
+    report["precision"] = precision
+    report["video"] = args.test_names[0]
+    for k, v in report.items():
+        logging.info("{:>20s}: {}".format(k, v))
+    report_file = os.path.join(args.getdir(), "quant_report_{}_{}.json".format(precision, args.log_time))
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Report saved to {}".format(report_file))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cfg', default='train', required=True, type=str,
+                        help='Your detailed configuration of the network')
+    parser.add_argument("--precision", default="int8", type=str, help="int8 or bf16")
+    parser.add_argument("--calib_batches", default=16, type=int, help="Batches of the INT8 calibration pass")
+    parser.add_argument("--calib_bs", default=32, type=int, help="Batch size of calibration and evaluation")
+    parser.add_argument("--eval_frames", default=1024, type=int, help="Frames of the held-out video compared with fp32")
+
+    args = parser.parse_args()
+    args = ParserUse(args.cfg, log="quantize").add_args(args)
+
+    args.makedir()
+    quantize_resnet(args)
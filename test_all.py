@@ -24,6 +24,7 @@ if __name__ == "__main__":
     args = argparse.ArgumentParser()
     args.add_argument("--cfg", default="train", type=str, required=True)
     args.add_argument("-n", default="", type=str, help="Notes for training")
+    args.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
     args = args.parse_args()
     args = ParserUse(args.cfg, "test_all").add_args(args)
 
@@ -1,9 +1,11 @@
 import os
+import copy
 import pickle
 import random
 import logging
 import shutil
 import argparse
+import cv2
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -19,7 +21,11 @@ from model.transformer import Transformer
 from dataset.esd import VideoSample
 
 from utils.parser import ParserUse
-from utils.util import plot_class_band
+from utils.util import plot_class_band, get_device
+from utils.preprocess import FramePreprocessor
+from utils.change_detector import ChangeDetector
+from utils.feature_store import load_features
+from generate_resnet import generate_features
 
 
 phase_dict = {}
@@ -33,27 +39,51 @@ for i, phase in enumerate(phase_dict_key):
     label_dict[i] = phase
 
 
+def reuse_indices(img_names, detector, device):
+    """
+    Simulate the online feature reuse on the frames of one video.
+    :param img_names: image files of the frames.
+    :param detector: ChangeDetector, reset for the video.
+    :return: for every frame, the index of the frame whose backbone feature is used.
+    """
+    preprocessor = FramePreprocessor()
+    detector.reset()
+    idxs = []
+    for i, img_name in enumerate(img_names):
+        inputs = preprocessor(cv2.imread(img_name), bgr=True).to(device)
+        idxs.append(idxs[-1] if detector.check(inputs) else i)
+    return idxs
+
+
+def predict(fusion_model, trans_model, img_featrues0):
+    img_featrues = torch.transpose(img_featrues0, 1, 2)
+    features = fusion_model(img_featrues).squeeze(1)  # Shifted predictions for all frames
+
+    # [1, 32, 2321]. [1, 2321, 2048]
+    return trans_model(features.detach(), img_featrues0).squeeze()
+
+
 def test_model(args):
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed(args.seed)
     logging.info("\n\n\n" + "|| "*10 + "Begin testing model")
+    device = get_device(args.device)
 
     fusion_model = MultiStageModel(args.mstcn_stages, args.mstcn_layers, args.mstcn_f_maps, args.mstcn_f_dim, args.out_classes, True, is_train=False)
-    fusion_model.load_state_dict(torch.load(args.fusion_model), strict=True)
-    fusion_model.cuda()
+    fusion_model.load_state_dict(torch.load(args.fusion_model, map_location=device), strict=True)
+    fusion_model.to(device)
     fusion_model.eval()
 
     trans_model = Transformer(args.mstcn_f_maps, args.mstcn_f_dim, args.out_classes, args.trans_seq, d_model=args.mstcn_f_maps)
-    trans_model.load_state_dict(torch.load(args.trans_model))
-    trans_model.cuda()
+    trans_model.load_state_dict(torch.load(args.trans_model, map_location=device))
+    trans_model.to(device)
     trans_model.eval()
 
     with open(args.data_file, "rb") as f:
         data_dict = pickle.load(f)
-    with open(args.emb_file, "rb") as f:
-        emb_dict = pickle.load(f)
+    emb_dict = load_features(args.emb_file)
 
     test_data = VideoSample(data_dict=data_dict, data_idxs=args.test_names, data_features=emb_dict, is_train=False, get_name=True)
     test_loader = DataLoader(test_data, batch_size=1, shuffle=False, num_workers=0, drop_last=False)
@@ -61,15 +91,22 @@ def test_model(args):
     if not os.path.isdir(args.pred_folder):
         os.makedirs(args.pred_folder)
 
+    # Backbone feature reuse of near-duplicate frames, evaluated against the predictions with all features
+    detector = ChangeDetector(args.reuse_threshold, args.reuse_max or 10) if args.reuse_threshold else None
+    full_preds = {}
+    reuse_counts = [0, 0]
+
     pred_label_files = []
     with torch.no_grad():
         for data in tqdm(test_loader, desc="Predicting"):
-            img_featrues0, img_names = data[0].cuda(non_blocking=True), data[1]
-            img_featrues = torch.transpose(img_featrues0, 1, 2)
-            features = fusion_model(img_featrues).squeeze(1)  # Shifted predictions for all frames
-
-            # [1, 32, 2321]. [1, 2321, 2048]
-            p_classes = trans_model(features.detach(), img_featrues0).squeeze()
+            img_featrues0, img_names = data[0].to(device, non_blocking=True), data[1]
+            if detector is not None:
+                full_pred = torch.argmax(predict(fusion_model, trans_model, img_featrues0), dim=-1).cpu().numpy()
+                idxs = reuse_indices([img_name[0] for img_name in img_names], detector, device)
+                img_featrues0 = img_featrues0[:, idxs]
+                reuse_counts[0] += detector.num_reused
+                reuse_counts[1] += detector.num_frames
+            p_classes = predict(fusion_model, trans_model, img_featrues0)
             preds = torch.argmax(p_classes, dim=-1).cpu().numpy().tolist()
             p_classes = p_classes.cpu().numpy()
             pd_label = pd.DataFrame({"Frame": list(range(1, len(preds)+1, 1)),
@@ -91,8 +128,13 @@ def test_model(args):
             save_file = os.path.join(args.pred_folder, base_name)
             pd_label.to_csv(save_file, index=False, header=None, sep="\t")
             pred_label_files.append(save_file)
+            if detector is not None:
+                full_preds[save_file] = full_pred.tolist()
+                logging.info("{}: features reused for {:.2%} of the frames, predictions changed for {:.2%}".format(
+                    base_name, detector.reuse_rate, np.mean(full_pred != np.array(preds))))
     print("Finished")
     accs = []
+    full_accs = []
     for pred_label_file in pred_label_files:
         base_name = os.path.basename(pred_label_file)
         gt_label_file = os.path.join(args.label_dir, os.path.basename(pred_label_file).split('_T_')[-1])
@@ -107,9 +149,17 @@ def test_model(args):
         acc = metrics.accuracy_score(gt_label, pred_label)
         accs.append(acc)
         logging.info("Accuracy {:>10.5f}".format(acc))
+        if detector is not None:
+            full_acc = metrics.accuracy_score(gt_label, full_preds[pred_label_file])
+            full_accs.append(full_acc)
+            logging.info("Accuracy without feature reuse {:>10.5f}".format(full_acc))
         # logging.info("Precision {:>10.5f}\n".format(metrics.precision_score(gt_label, pred_label, average='micro')))
         # plot_class_band(gt_label, pred_label, os.path.join(args.pred_folder, base_name.replace(".txt", ".pdf")), "{:>4.3f}".format(acc))
     print("|| "*10, "Mean: {:10.5f}".format(sum(accs) / len(accs)))
+    args.test_acc = sum(accs) / len(accs)
+    if detector is not None:
+        print("|| "*10, "Mean without feature reuse: {:10.5f}, reuse rate: {:.2%}".format(
+            sum(full_accs) / len(full_accs), reuse_counts[0] / max(reuse_counts[1], 1)))
 
     # Read predictions
     predictions = pd.read_csv('predictions/transformer_T_AI.txt', 
@@ -126,11 +176,26 @@ def test_model(args):
     return args
 
 
+def test_backbone(args, resnet_model):
+    """
+    Phase accuracy on the testing videos with the features of another backbone checkpoint, e.g. a distilled or pruned
+    one. The temporal models of the configs are used unchanged.
+    :return: mean accuracy.
+    """
+    args = copy.deepcopy(args)
+    args.resnet_model = resnet_model
+    args = generate_features(args)
+    return test_model(args).test_acc
+
+
 if __name__ == "__main__":
 
     args = argparse.ArgumentParser()
     args.add_argument("--cfg", default="train", required=True, type=str, help="Config file")
     args.add_argument("-n", default="", help="Note for testing")
+    args.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
+    args.add_argument("--reuse_threshold", default=None, type=float, help="Evaluate backbone feature reuse of unchanged frames with this threshold")
+    args.add_argument("--reuse_max", default=None, type=int, help="Maximum consecutive frames reusing one feature")
 
     args = args.parse_args()
     args = ParserUse(args.cfg, "test").add_args(args)
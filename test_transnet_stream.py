@@ -9,12 +9,14 @@ from tqdm import tqdm
 import numpy as np
 import pandas as pd
 from time import time
-import albumentations as A
 
-from model.resnet import ResNet
+from model.resnet import load_backbone
 from model.mstcn import MultiStageModel
 from model.transformer import Transformer
 from utils.parser import ParserUse
+from utils.util import get_device
+from utils.feature_cache import FeatureCache
+from utils.preprocess import FramePreprocessor
 
 from torch.utils.data import DataLoader
 from dataset.esd import VideoSample
@@ -50,15 +52,12 @@ class PhaseSeg(object):
         self.arg = arg
         self.model = self.load_model()
         self.out_file = os.path.join("./results", os.path.basename(input_file)) if out_file is None else out_file
-        self.frame_feature_cache = None
-        self.frame_cache_len = 2 ** (self.arg.mstcn_layers + 1) - 1
-        self.temporal_feature_cache = None
+        # The MS-TCN history lives in fusion_state, so only the steps read by transformer.forward_last are cached
+        self.frame_cache_len = max(self.transformer.len_q, self.transformer.spa_len)
+        self.frame_feature_cache = FeatureCache(self.frame_cache_len)
+        self.temporal_feature_cache = FeatureCache(self.frame_cache_len)
         self.label2phase_dict = label_dict
-        self.aug = A.Compose([
-            A.Resize(250, 250),
-            A.CenterCrop(224, 224),
-            A.Normalize()
-        ])
+        self.preprocessor = FramePreprocessor()
         self.label_file = label_file
         self.quiet = quiet
         if label_file is not None:
@@ -102,54 +101,49 @@ class PhaseSeg(object):
         """
         Function loads the yolo5 model from PyTorch Hub.
         """
-        self.resnet = ResNet(out_channels=self.hypers.out_classes, has_fc=False)
-        paras = torch.load(self.hypers.resnet_model)["model"]
-        paras = {k: v for k, v in paras.items() if "fc" not in k}
-        paras = {k: v for k, v in paras.items() if "embed" not in k}
-        self.resnet.load_state_dict(paras, strict=True)
-        self.resnet.cuda()
-        self.resnet.eval()
+        self.device = get_device(self.hypers.device)
+        self.resnet = load_backbone(self.hypers, self.device)
 
         self.fusion = MultiStageModel(mstcn_stages=self.hypers.mstcn_stages, mstcn_layers=self.hypers.mstcn_layers,
                                       mstcn_f_maps=self.hypers.mstcn_f_maps, mstcn_f_dim=self.hypers.mstcn_f_dim,
                                       out_features=self.hypers.out_classes, mstcn_causal_conv=True, is_train=False)
-        paras = torch.load(self.hypers.fusion_model)
+        paras = torch.load(self.hypers.fusion_model, map_location=self.device)
         self.fusion.load_state_dict(paras)
-        self.fusion.cuda()
+        self.fusion.to(self.device)
         self.fusion.eval()
+        self.fusion_state = self.fusion.init_stream()
 
         self.transformer = Transformer(self.hypers.mstcn_f_maps, self.hypers.mstcn_f_dim, self.hypers.out_classes, self.hypers.trans_seq, d_model=self.hypers.mstcn_f_maps)
-        paras = torch.load(self.hypers.trans_model)
+        paras = torch.load(self.hypers.trans_model, map_location=self.device)
         self.transformer.load_state_dict(paras)
-        self.transformer.cuda()
+        self.transformer.to(self.device)
         self.transformer.eval()
 
     def cache_frame_features(self, feature):
-        if self.frame_feature_cache is None:
-            self.frame_feature_cache = feature
-        elif self.frame_feature_cache.shape[0] > self.frame_cache_len:
-            self.frame_feature_cache = torch.cat([self.frame_feature_cache[1:], feature], dim=0)
-        else:
-            self.frame_feature_cache = torch.cat([self.frame_feature_cache, feature], dim=0)
-        return self.frame_feature_cache
+        return self.frame_feature_cache.append(feature)
+
+    def cache_temporal_features(self, feature):
+        # [1, C, 1] is cached as one row per time step and returned as [1, C, N]
+        return self.temporal_feature_cache.append(feature[0].t()).t().unsqueeze(0)
 
-    def seg_frame(self, frame):
+    def seg_frame(self, frame, bgr=False):
         """
         function scores each frame of the video and returns results.
         :param frame: frame to be infered.
+        :param bgr: frame is BGR as read by OpenCV.
         :return: labels and coordinates of objects found.
         """
-        frame = self.aug(image=frame)["image"]
+        frame = self.preprocessor(frame, bgr).to(self.device)
         with torch.no_grad():
-            frame = np.expand_dims(np.transpose(frame, [2, 0, 1]), axis=0)
-            frame = torch.tensor(frame).cuda()
             frame_feature = self.resnet(frame)
             # print(frame_feature.size())
             cat_frame_feature = self.cache_frame_features(frame_feature).unsqueeze(0)
-            temporal_feature = self.fusion(cat_frame_feature.transpose(1, 2))
+            # Only the newest time step goes through the causal MS-TCN, earlier steps are kept in fusion_state
+            temporal_feature = self.fusion.forward_step(frame_feature.unsqueeze(-1), self.fusion_state)
+            temporal_feature = self.cache_temporal_features(temporal_feature)
 
-            # Temporal feature: [1, 5, 512], Frame feature：[1, 512, 2048]
-            pred = self.transformer(temporal_feature.detach(), cat_frame_feature)[-1].cpu().numpy()
+            # Temporal feature: [1, 32, N], Frame feature：[1, N, 2048]
+            pred = self.transformer.forward_last(temporal_feature.detach(), cat_frame_feature)[-1].cpu().numpy()
         return self.label2phase_dict[np.argmax(pred, axis=0)]
 
     def plot_boxes(self, results, frame):
@@ -180,6 +174,58 @@ class PhaseSeg(object):
 
         return frame
 
+    def extract_features(self, batch_size):
+        """
+        Backbone features of all frames of the video, computed in batches.
+        :param batch_size: number of frames per backbone call.
+        :return: frame features  [N, 2048]
+        """
+        player = self.get_video_from_file()
+        assert player.isOpened()
+        frames = torch.empty((batch_size, 3, self.preprocessor.crop, self.preprocessor.crop))
+        features = []
+        num = 0
+        with torch.no_grad():
+            while True:
+                ret, frame = player.read()
+                if ret:
+                    frames[num] = self.preprocessor(frame, bgr=True)[0]
+                    num += 1
+                if num == batch_size or (not ret and num > 0):
+                    features.append(self.resnet(frames[:num].to(self.device)))
+                    num = 0
+                if not ret:
+                    break
+        player.release()
+        if not features:
+            raise ValueError("No frames could be decoded from {}".format(self.input_file))
+        return torch.cat(features, dim=0)
+
+    def offline(self, batch_size=64, chunk=4096):
+        """
+        Batched prediction of a recorded video, equal to the frame-by-frame predictions of __call__.
+        The causal MS-TCN runs once over the whole sequence, the transformer over chunks of frames
+        with enough preceding frames to fill the windows of the first frame of a chunk.
+        :param batch_size: number of frames per backbone call.
+        :param chunk: number of frames per transformer call, bounds the memory of the sliding windows.
+        """
+        start_time = time()
+        features = self.extract_features(batch_size)
+        num_frames = features.size(0)
+        context = max(self.transformer.len_q, self.transformer.spa_len) - 1
+        preds = []
+        with torch.no_grad():
+            temporal_features = self.fusion(features.t().unsqueeze(0))  # [1, 32, N]
+            for start in range(0, num_frames, chunk):
+                low = max(0, start - context)
+                end = min(start + chunk, num_frames)
+                p_classes = self.transformer(temporal_features[:, :, low:end], features[low:end].unsqueeze(0))
+                preds.append(torch.argmax(p_classes[start - low:], dim=-1).cpu())
+        preds = [self.label2phase_dict[int(pred)] for pred in torch.cat(preds).numpy()]
+        print("{} frames in {:.1f}s".format(num_frames, time() - start_time))
+        self.save_preds(preds)
+        return preds
+
     def __call__(self):
         player = self.get_video_from_file() # create streaming service for application
         assert player.isOpened()
@@ -197,15 +243,13 @@ class PhaseSeg(object):
             ret, frame = player.read()
             if not ret:
                 break
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            results = self.seg_frame(frame)
+            results = self.seg_frame(frame, bgr=True)
             preds.append(results)
             end_time = time()
             if tfcc % 10 == 1:
                 fps = 1/np.round(end_time - start_time, 3)
                 print("{:10.5f}".format(fps))
             frame = self.add_text(tfcc, results, fps, frame)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
             out.write(frame)
             if not self.quiet:
                 cv2.imshow('frame', frame)
@@ -221,6 +265,9 @@ if __name__ == "__main__":
     parse.add_argument("-d", default=None, type=str, help="File to save processed video")
     parse.add_argument("-q", default=False, action='store_true', help="Display video")
     parse.add_argument("--cfg", default="train", type=str)
+    parse.add_argument("--device", default=None, type=str, help="cuda, cpu or auto, overrides the config")
+    parse.add_argument("--offline", default=False, action='store_true', help="Batched prediction without display and video output")
+    parse.add_argument("--bs", default=64, type=int, help="Backbone batch size of the offline mode")
 
     cfg = parse.parse_args()
     cfg = ParserUse(cfg.cfg, "stream").add_args(cfg)
@@ -231,9 +278,16 @@ if __name__ == "__main__":
             print(videos[case_idx])
             cfg.f = videos[case_idx]
             phase_seg = PhaseSeg(cfg.f, cfg, cfg.d, quiet=cfg.q, arg=cfg)
-            phase_seg()
+            if cfg.offline:
+                phase_seg.offline(cfg.bs)
+            else:
+                phase_seg()
     else:
         phase_seg = PhaseSeg(cfg.f, cfg, cfg.d, quiet=cfg.q, arg=cfg)
+        if cfg.offline:
+            phase_seg.offline(cfg.bs)
+        else:
+            phase_seg()
 
 
     #
@@ -21,6 +21,7 @@ from model.transformer import Transformer
 from dataset.esd import VideoSample, FeatureDataset
 from utils.util import plot_loss
 from utils.losses import FocalLoss
+from utils.feature_store import load_features
 
 
 def train_trans(args):
@@ -48,8 +49,7 @@ def train_trans(args):
     focal_loss.cuda()
     with open(args.data_file, "rb") as f:
         data_dict = pickle.load(f)
-    with open(args.emb_file, "rb") as f:
-        emb_dict = pickle.load(f)
+    emb_dict = load_features(args.emb_file)
 
     train_data = VideoSample(data_dict=data_dict, data_idxs=args.train_names, data_features=emb_dict, is_train=True)
     val_data = VideoSample(data_dict=data_dict, data_idxs=args.val_names, data_features=emb_dict, is_train=True)
@@ -29,10 +29,11 @@ def train_resnet(args):
     logging.info("|| "*10 + "Begin training resnet50")
 
     setproctitle("1Resnet")
-    model = ResNet(has_fc=True)
-    if os.path.isfile(args.start_iter):
-        paras = torch.load(args.start_iter)["model"]
-        model.load_state_dict(paras)
+    # Checkpoints of prune_resnet.py carry the widths of their pruned bottlenecks
+    checkpoint = torch.load(args.start_iter, map_location="cpu") if os.path.isfile(args.start_iter) else {}
+    model = ResNet(has_fc=True, pretrained=not checkpoint, widths=checkpoint.get("widths"))
+    if checkpoint:
+        model.load_state_dict(checkpoint["model"])
     model.cuda()
 
     optimizer = optim.SGD(params=model.parameters(),
@@ -98,6 +99,7 @@ def train_resnet(args):
                     save_file = os.path.join(args.save_model, "resnet50_{}_best.pth".format(args.log_time))
                     args.resnet_model = save_file
                     torch.save({"model": model.state_dict(),
+                                "widths": model.widths,
                                 "optim": optimizer.state_dict()}, save_file)
                     logging.info("Saving model at itreation {}".format(iterations))
 
@@ -114,6 +116,7 @@ def train_resnet(args):
     save_file = os.path.join(args.save_model, "resnet50_{}_last.pth".format(args.log_time))
     args.resnet_model = save_file
     torch.save({"model": model.state_dict(),
+                "widths": model.widths,
                 "optim": optimizer.state_dict()}, save_file)
 
     logging.info("Trained model saved to {}".format(save_file))
@@ -0,0 +1,130 @@
+import time
+from threading import Thread, Condition
+
+import cv2
+
+
+class FrameSlot(object):
+    """
+    Single-slot hand-over of the latest frame from a capture thread to a consumer.
+    Consumers wait on a condition variable instead of polling, and a frame that is replaced
+    before it was taken is counted as dropped.
+    """
+    def __init__(self):
+        self.cond = Condition()
+        self.frame = None
+        self.seq = 0  # Sequence number of the latest frame
+        self.time = 0.
+        self.taken = True
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame):
+        with self.cond:
+            if not self.taken:
+                self.dropped += 1
+            # The slot only swaps references, every frame from VideoCapture.read is a new array
+            self.frame = frame
+            self.seq += 1
+            self.time = time.time()
+            self.taken = False
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Wait for a frame that has not been taken yet.
+        :param timeout: seconds to wait, None waits until a frame arrives or the slot is closed.
+        :return: (seq, frame, capture time), None on timeout or when the slot is closed.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: not self.taken or self.closed, timeout)
+            if self.taken:
+                return None
+            self.taken = True
+            return self.seq, self.frame, self.time
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class CameraCapture(object):
+    """
+    Reads a camera or video in a background thread into a FrameSlot.
+    """
+    def __init__(self, source=0):
+        self.player = cv2.VideoCapture(source)
+        self.slot = FrameSlot()
+        self.running = True
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        # VideoCapture.read blocks until the next frame is delivered, so the thread never spins
+        while self.running and self.player.isOpened():
+            ret, frame = self.player.read()
+            if not ret:
+                break
+            self.slot.put(frame)
+        self.slot.close()
+
+    def read(self, timeout=None):
+        return self.slot.get(timeout)
+
+    @property
+    def dropped(self):
+        return self.slot.dropped
+
+    def release(self):
+        self.running = False
+        self.thread.join()
+        self.player.release()
+
+
+class FrameSource(object):
+    """
+    Video or camera reader with separate display and inference sampling.
+    Every frame is grabbed to keep the stream position, but only frames on the display or inference grid
+    are retrieved, i.e. converted to BGR and copied out of the decoder.
+    """
+    def __init__(self, source, display_ratio=1, infer_ratio=1):
+        """
+        :param source: video file or camera index.
+        :param display_ratio: every display_ratio-th frame is displayed.
+        :param infer_ratio: every infer_ratio-th frame is passed to the models, e.g. down_ratio.
+        """
+        self.cap = cv2.VideoCapture(source)
+        self.display_ratio = max(1, int(display_ratio))
+        self.infer_ratio = max(1, int(infer_ratio))
+        self.frame_idx = 0
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+
+    def read(self):
+        """
+        Advance by one frame.
+        :return: (ret, frame, frame_idx, display, infer), frame is None if the frame is neither displayed nor inferred.
+        """
+        if not self.cap.grab():
+            return False, None, self.frame_idx, False, False
+        self.frame_idx += 1
+        display = self.frame_idx % self.display_ratio == 0
+        infer = self.frame_idx % self.infer_ratio == 0
+        frame = None
+        if display or infer:
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                return False, None, self.frame_idx, False, False
+        return True, frame, self.frame_idx, display, infer
+
+    def release(self):
+        self.cap.release()
@@ -0,0 +1,50 @@
+import torch.nn.functional as F
+
+
+class CascadeGate(object):
+    """
+    Decides per frame of a stream whether the features of the light backbone are used or ResNet50 has to run.
+    ResNet50 runs when the temporal head was not confident on the previous frame, when the light feature drifted away
+    from the one of the last ResNet50 frame, or after interval frames without ResNet50.
+    """
+    def __init__(self, confidence=0.8, drift=0.1, interval=30):
+        """
+        :param confidence: minimum softmax probability of the previous prediction to stay on the light backbone.
+        :param drift: maximum cosine distance of the light feature to the one of the last ResNet50 frame.
+        :param interval: maximum number of consecutive frames on the light backbone.
+        """
+        self.confidence = confidence
+        self.drift = drift
+        self.interval = interval
+        self.reference = None
+        self.light_frames = 0  # Consecutive frames on the light backbone
+        self.num_frames = 0
+        self.num_escalated = 0
+
+    def check(self, light_feature, confidence):
+        """
+        :param light_feature: feature of the light backbone  [1, 2048]
+        :param confidence: softmax probability of the previous prediction of the stream, None before the first one.
+        :return: True if ResNet50 has to run on the frame.
+        """
+        self.num_frames += 1
+        escalate = self.reference is None or confidence is None or confidence < self.confidence \
+            or self.light_frames >= self.interval \
+            or 1 - F.cosine_similarity(light_feature, self.reference).item() > self.drift
+        if escalate:
+            self.reference = light_feature
+            self.light_frames = 0
+            self.num_escalated += 1
+        else:
+            self.light_frames += 1
+        return escalate
+
+    @property
+    def escalation_rate(self):
+        return self.num_escalated / max(self.num_frames, 1)
+
+    def reset(self):
+        self.reference = None
+        self.light_frames = 0
+        self.num_frames = 0
+        self.num_escalated = 0
@@ -0,0 +1,58 @@
+import torch.nn.functional as F
+
+
+class ChangeDetector(object):
+    """
+    Detects near-duplicate frames of a stream, e.g. while the camera is held still, so the backbone feature of the
+    last computed frame can be reused. Frames are compared as small thumbnails of the normalized backbone input
+    against the last frame the backbone was run on, so slow drifts still trigger a new feature.
+    """
+    def __init__(self, threshold, max_reuse=10, size=16):
+        """
+        :param threshold: mean absolute thumbnail difference below which a frame counts as unchanged.
+        :param max_reuse: maximum number of consecutive frames reusing one feature.
+        :param size: side length of the thumbnails.
+        """
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.size = size
+        self.reference = None
+        self.reused = 0  # Consecutive reuses of the current reference
+        self.num_frames = 0
+        self.num_reused = 0
+
+    def thumbnail(self, inputs):
+        """
+        :param inputs: normalized frames  [N, 3, H, W]
+        :return: [N, 3 * size * size]
+        """
+        return F.adaptive_avg_pool2d(inputs.float(), self.size).flatten(1)
+
+    def difference(self, thumbnail, reference):
+        return (thumbnail - reference).abs().mean().item()
+
+    def check(self, inputs):
+        """
+        :param inputs: normalized frame  [1, 3, H, W]
+        :return: True if the feature of the last computed frame can be reused, otherwise the frame becomes the reference.
+        """
+        self.num_frames += 1
+        thumbnail = self.thumbnail(inputs)
+        if self.reference is not None and self.reused < self.max_reuse \
+                and self.difference(thumbnail, self.reference) < self.threshold:
+            self.reused += 1
+            self.num_reused += 1
+            return True
+        self.reference = thumbnail
+        self.reused = 0
+        return False
+
+    @property
+    def reuse_rate(self):
+        return self.num_reused / max(self.num_frames, 1)
+
+    def reset(self):
+        self.reference = None
+        self.reused = 0
+        self.num_frames = 0
+        self.num_reused = 0
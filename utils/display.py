@@ -0,0 +1,88 @@
+import time
+import logging
+from threading import Thread
+
+import cv2
+import numpy as np
+
+from utils.capture import FrameSlot
+
+
+class DisplayWorker(object):
+    """
+    Prepares frames for display in a background thread: frames are scaled to the display size keeping the aspect
+    ratio and converted to RGB in reusable buffers, so the GUI thread only swaps pixmaps.
+    Frames arriving faster than they are prepared are skipped, only the latest one is shown.
+    """
+    def __init__(self, width, height, prepare=None, num_buffers=3, monitor=None):
+        """
+        :param width: width of the display area.
+        :param height: height of the display area.
+        :param prepare: called in this thread with the RGB display buffer before it is shown, e.g. to draw overlays.
+        :param num_buffers: display buffers reused in turn, a buffer is overwritten num_buffers frames later.
+        :param monitor: LatencyMonitor receiving the display preparation times.
+        """
+        self.width = width
+        self.height = height
+        self.prepare = prepare
+        self.num_buffers = num_buffers
+        self.monitor = monitor
+        self.source_shape = None
+        self.scaled = None
+        self.buffers = []
+        self.buffer_idx = 0
+        self.frames = FrameSlot()
+        self.displays = FrameSlot()
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, frame):
+        """
+        :param frame: BGR frame as read by OpenCV, it must not be modified afterwards.
+        """
+        self.frames.put(frame)
+
+    def allocate(self, shape):
+        scale = min(self.width / shape[1], self.height / shape[0])
+        width, height = max(1, int(shape[1] * scale)), max(1, int(shape[0] * scale))
+        self.scaled = np.empty((height, width, 3), dtype=np.uint8)
+        self.buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(self.num_buffers)]
+        self.source_shape = shape
+
+    def run(self):
+        while True:
+            item = self.frames.get()
+            if item is None:  # Closed
+                break
+            _, frame, _ = item
+            try:
+                start_time = time.time()
+                if frame.shape != self.source_shape:
+                    self.allocate(frame.shape)
+                buffer = self.buffers[self.buffer_idx]
+                self.buffer_idx = (self.buffer_idx + 1) % self.num_buffers
+                cv2.resize(frame, (buffer.shape[1], buffer.shape[0]), dst=self.scaled, interpolation=cv2.INTER_LINEAR)
+                cv2.cvtColor(self.scaled, cv2.COLOR_BGR2RGB, dst=buffer)
+                if self.monitor is not None:
+                    self.monitor.record("display", time.time() - start_time)
+                if self.prepare is not None:
+                    self.prepare(buffer)
+                self.displays.put(buffer)
+            except Exception as e:
+                logging.error(f"Error in display worker: {e}")
+
+    def latest(self):
+        """
+        :return: the newest prepared RGB buffer, None if nothing new was prepared since the last call.
+        """
+        item = self.displays.get(timeout=0)
+        return None if item is None else item[1]
+
+    @property
+    def dropped(self):
+        return self.frames.dropped
+
+    def close(self):
+        self.frames.close()
+        self.thread.join()
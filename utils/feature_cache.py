@@ -0,0 +1,41 @@
+class FeatureCache(object):
+    """
+    Fixed-capacity ring buffer of frame-wise features for streaming inference.
+    Every row is written twice into a storage of 2 x capacity rows, so the latest window is
+    always one contiguous slice of the storage and appending never reallocates memory.
+    """
+    def __init__(self, capacity):
+        """
+        :param capacity: maximum number of time steps kept in the window.
+        """
+        self.capacity = capacity
+        self.storage = None
+        self.pos = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def reset(self):
+        self.pos = 0
+        self.length = 0
+
+    def append(self, feature):
+        """
+        Write new time steps in place and return the updated window.
+        :param feature: features of the new time steps  [T, ...], time steps are stored along the first dim.
+        :return: view of the latest window  [min(#steps, capacity), ...], valid until the next append.
+        """
+        if self.storage is None:
+            # Allocated once with the full capacity, so the memory footprint is constant from the first frame
+            self.storage = feature.new_zeros((2 * self.capacity,) + tuple(feature.shape[1:]))
+        for row in feature:
+            self.storage[self.pos] = row
+            self.storage[self.pos + self.capacity] = row
+            self.pos = (self.pos + 1) % self.capacity
+            self.length = min(self.length + 1, self.capacity)
+        return self.get()
+
+    def get(self):
+        end = self.pos + self.capacity
+        return self.storage[end - self.length:end]
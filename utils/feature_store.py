@@ -0,0 +1,105 @@
+import os
+import json
+import pickle
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+
+class FeatureStore(object):
+    """
+    Read-only frame features of every video, one contiguous .npy shard per video listed in index.json.
+    Shards are opened memory-mapped on first access, so loading is instant, the pages are shared between DataLoader
+    workers and the features of a video are returned without copying.
+    """
+    def __init__(self, store_dir):
+        """
+        :param store_dir: directory written by FeatureWriter.
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE), "r") as f:
+            self.index = json.load(f)
+        self.shards = {}
+
+    def __getstate__(self):
+        # Workers reopen the shards instead of receiving pickled copies of the mapped arrays
+        return {"store_dir": self.store_dir, "index": self.index, "shards": {}}
+
+    def __getitem__(self, name):
+        """
+        :return: read-only features of the video  [#frames, dim]
+        """
+        if name not in self.shards:
+            shard = np.load(os.path.join(self.store_dir, self.index[name]["file"]), mmap_mode="r")
+            self.shards[name] = shard.view(np.ndarray)
+        return self.shards[name]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, name, default=None):
+        return self[name] if name in self.index else default
+
+
+class FeatureWriter(object):
+    """
+    Writes the features of a FeatureStore in place into preallocated shards, in any order of the videos.
+    The index is written last by close(), so an interrupted run never leaves a readable but incomplete store.
+    """
+    def __init__(self, store_dir, frame_counts, dim, dtype="float32"):
+        """
+        :param frame_counts: number of frames of every video, {name: #frames}
+        :param dim: feature dimension.
+        """
+        self.store_dir = store_dir
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.index = {}
+        self.shards = {}
+        self.cursors = {}
+        for name, num_frames in frame_counts.items():
+            file_name = "{}.npy".format(name)
+            self.index[name] = {"file": file_name, "frames": num_frames, "dim": dim}
+            self.shards[name] = np.lib.format.open_memmap(os.path.join(store_dir, file_name), mode="w+",
+                                                          dtype=dtype, shape=(num_frames, dim))
+            self.cursors[name] = 0
+
+    def write(self, name, features):
+        """
+        Append the features of consecutive frames of a video.
+        :param features: [#frames, dim]
+        """
+        start = self.cursors[name]
+        if start + len(features) > len(self.shards[name]):
+            raise ValueError("#features > #imgs of {}".format(name))
+        self.shards[name][start:start + len(features)] = features
+        self.cursors[name] = start + len(features)
+
+    def close(self):
+        for name, shard in self.shards.items():
+            if self.cursors[name] != len(shard):
+                raise ValueError("#imgs != #features of {}, {} != {}".format(name, len(shard), self.cursors[name]))
+            shard.flush()
+        self.shards = {}
+        tmp_file = os.path.join(self.store_dir, INDEX_FILE + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_file, os.path.join(self.store_dir, INDEX_FILE))
+
+
+def load_features(emb_file):
+    """
+    Features made by generate_features, a FeatureStore directory or a pickled dict of per-frame features of
+    earlier runs.
+    """
+    if os.path.isdir(emb_file):
+        return FeatureStore(emb_file)
+    with open(emb_file, "rb") as f:
+        return pickle.load(f)
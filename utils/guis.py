@@ -10,17 +10,26 @@ from tqdm import tqdm
 from datetime import datetime
 import numpy as np
 import pandas as pd
-import albumentations as A
-from threading import Thread
 
-from model.resnet import ResNet
+from model.resnet import load_backbone, load_light_backbone
 from model.mstcn import MultiStageModel
 from model.transformer import Transformer
 from utils.parser import ParserUse
+from utils.util import get_device
+from utils.feature_cache import FeatureCache
+from utils.capture import CameraCapture
+from utils.preprocess import FramePreprocessor
+from utils.recorder import VideoRecorder
+from utils.overlay import TextOverlay
+from utils.change_detector import ChangeDetector
+from utils.cascade import CascadeGate
 
 from torch.utils.data import DataLoader
 from dataset.esd import VideoSample
 
+# Bottom-left corners of the time, phase and trainee lines of the overlay
+TEXT_ORIGINS = [(30, 30), (30, 60), (30, 90)]
+
 phase_dict = {}
 phase_dict_key = ['idle', 'marking', 'injection', 'dissection']
 for i in range(len(phase_dict_key)):
@@ -54,32 +63,21 @@ class PhaseSeg(object):
         self.video_file = os.path.join("./results/records", "record_{}.avi".format(self.arg.log_time))
         if not os.path.isdir(os.path.dirname(self.video_file)):
             os.makedirs(os.path.dirname(self.video_file))
-        self.frame_feature_cache = None
-        self.frame_cache_len = 2 ** (self.arg.mstcn_layers + 1) - 1
-        self.temporal_feature_cache = None
+        # The MS-TCN history lives in fusion_state, so only the steps read by transformer.forward_last are cached
+        self.frame_cache_len = max(self.transformer.len_q, self.transformer.spa_len)
+        self.frame_feature_cache = FeatureCache(self.frame_cache_len)
+        self.temporal_feature_cache = FeatureCache(self.frame_cache_len)
         self.label2phase_dict = label_dict
-        self.aug = A.Compose([
-            A.Resize(250, 250),
-            A.CenterCrop(224, 224),
-            A.Normalize()
-        ])
-        self.frame_idx = 0
-        self.player = cv2.VideoCapture(0)
-        x_shape = int(self.player.get(cv2.CAP_PROP_FRAME_WIDTH))
-        y_shape = int(self.player.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.preprocessor = FramePreprocessor()
+        self.overlay = TextOverlay(TEXT_ORIGINS)
+        # Camera frames are handed over through a latest-frame slot, infer waits for new frames instead of polling
+        self.capture = CameraCapture(0)
         four_cc = cv2.VideoWriter_fourcc(*"XVID")
 
         if self.record:
-            self.out = cv2.VideoWriter(self.video_file, four_cc, 8, (x_shape, y_shape), True)
-        self.thread = Thread(target=self.get_frame, args=())
-        self.thread.daemon = True
-        self.thread.start()
-
-    def get_frame(self):
-        while True:
-            if self.player.isOpened():
-                self.frame_idx += 1
-                (self.status, self.frame) = self.player.read()
+            # Encoding runs in the recorder thread, a full queue drops frames instead of stalling inference
+            self.out = VideoRecorder(self.video_file, 8, codec=four_cc, segment_seconds=self.arg.record_segment or 600,
+                                     max_queue=self.arg.record_queue or 64)
 
     def save_preds(self, timestamps, frame_idxs, preds):
 
@@ -93,62 +91,54 @@ class PhaseSeg(object):
         """
         Function loads the yolo5 model from PyTorch Hub.
         """
-        self.resnet = ResNet(out_channels=self.arg.out_classes, has_fc=False)
-        paras = torch.load(self.arg.resnet_model)["model"]
-        paras = {k: v for k, v in paras.items() if "fc" not in k}
-        paras = {k: v for k, v in paras.items() if "embed" not in k}
-        self.resnet.load_state_dict(paras, strict=True)
-        self.resnet.cuda()
-        self.resnet.eval()
+        self.device = get_device(self.arg.device)
+        self.resnet = load_backbone(self.arg, self.device)
 
         self.fusion = MultiStageModel(mstcn_stages=self.arg.mstcn_stages, mstcn_layers=self.arg.mstcn_layers,
                                       mstcn_f_maps=self.arg.mstcn_f_maps, mstcn_f_dim=self.arg.mstcn_f_dim,
                                       out_features=self.arg.out_classes, mstcn_causal_conv=True, is_train=False)
-        paras = torch.load(self.arg.fusion_model)
+        paras = torch.load(self.arg.fusion_model, map_location=self.device)
         self.fusion.load_state_dict(paras)
-        self.fusion.cuda()
+        self.fusion.to(self.device)
         self.fusion.eval()
+        self.fusion_state = self.fusion.init_stream()
 
         self.transformer = Transformer(self.arg.mstcn_f_maps, self.arg.mstcn_f_dim, self.arg.out_classes, self.arg.trans_seq, d_model=self.arg.mstcn_f_maps)
-        paras = torch.load(self.arg.trans_model)
+        paras = torch.load(self.arg.trans_model, map_location=self.device)
         self.transformer.load_state_dict(paras)
-        self.transformer.cuda()
+        self.transformer.to(self.device)
         self.transformer.eval()
 
     def cache_frame_features(self, feature):
-        if self.frame_feature_cache is None:
-            self.frame_feature_cache = feature
-        elif self.frame_feature_cache.shape[0] > self.frame_cache_len:
-            self.frame_feature_cache = torch.cat([self.frame_feature_cache[1:], feature], dim=0)
-        else:
-            self.frame_feature_cache = torch.cat([self.frame_feature_cache, feature], dim=0)
-        return self.frame_feature_cache
+        return self.frame_feature_cache.append(feature)
 
-    def seg_frame(self, frame):
+    def cache_temporal_features(self, feature):
+        # [1, C, 1] is cached as one row per time step and returned as [1, C, N]
+        return self.temporal_feature_cache.append(feature[0].t()).t().unsqueeze(0)
+
+    def seg_frame(self, frame, bgr=False):
         """
         function scores each frame of the video and returns results.
         :param frame: frame to be infered.
+        :param bgr: frame is BGR as read by OpenCV.
         :return: labels and coordinates of objects found.
         """
-        frame = self.aug(image=frame)["image"]
+        frame = self.preprocessor(frame, bgr).to(self.device)
         with torch.no_grad():
-            frame = np.expand_dims(np.transpose(frame, [2, 0, 1]), axis=0)
-            frame = torch.tensor(frame).cuda()
             frame_feature = self.resnet(frame)
             # print(frame_feature.size())
             cat_frame_feature = self.cache_frame_features(frame_feature).unsqueeze(0)
-            temporal_feature = self.fusion(cat_frame_feature.transpose(1, 2))
+            # Only the newest time step goes through the causal MS-TCN, earlier steps are kept in fusion_state
+            temporal_feature = self.fusion.forward_step(frame_feature.unsqueeze(-1), self.fusion_state)
+            temporal_feature = self.cache_temporal_features(temporal_feature)
 
-            # Temporal feature: [1, 5, 512], Frame feature：[1, 512, 2048]
-            pred = self.transformer(temporal_feature.detach(), cat_frame_feature)[-1].cpu().numpy()
+            # Temporal feature: [1, 32, N], Frame feature：[1, N, 2048]
+            pred = self.transformer.forward_last(temporal_feature.detach(), cat_frame_feature)[-1].cpu().numpy()
         return self.label2phase_dict[np.argmax(pred, axis=0)]
 
     def add_text(self, fc, results, fps, frame):
-        cv2.putText(frame, "   Time: {:<55s}".format(fc), (30, 30),  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-        cv2.putText(frame, "  Phase: {:<15s}".format(results), (30, 60),  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-        cv2.putText(frame, " Trainee: {:<15s}".format(fps), (30, 90),  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-
-        return frame
+        texts = ["   Time: {:<55s}".format(fc), "  Phase: {:<15s}".format(results), " Trainee: {:<15s}".format(fps)]
+        return self.overlay.draw(texts, frame)
 
     def infer(self):
 
@@ -156,26 +146,28 @@ class PhaseSeg(object):
         preds = []
         timestamps = []
         frame_idxs = []
+        latencies = []
         results = ""
         fps = -1
         while True:
+            item = self.capture.read()
+            if item is None:  # Camera closed
+                break
+            frame_idx, raw_frame, capture_time = item
             tfcc += 1
             start_time = time.time()
-            if not self.status:
-                break
             date_time = datetime.now().strftime("%m/%d/%Y-%H:%M:%S.%f")
-            frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
             if tfcc % 5 == 1:
-                results = self.seg_frame(frame)
+                results = self.seg_frame(raw_frame, bgr=True)
                 timestamps.append(date_time)
-                frame_idxs.append(self.frame_idx)
+                frame_idxs.append(frame_idx)
                 preds.append(results)
+                latencies.append(time.time() - capture_time)
             end_time = time.time()
             if tfcc % 10 == 1:
                 fps = 1/np.round(end_time - start_time, 3)
 
-            frame = self.add_text(date_time, results, fps, self.frame)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            frame = self.add_text(date_time, results, fps, raw_frame)
             if self.record:
                 self.out.write(frame)
             if not self.quiet:
@@ -183,7 +175,13 @@ class PhaseSeg(object):
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     break
         self.save_preds(timestamps, frame_idxs, preds)
-        self.player.release()
+        self.capture.release()
+        if self.record:
+            self.out.close()
+            print("Recorded frames: {}, dropped: {}".format(self.out.written, self.out.dropped))
+        if latencies:
+            print("Capture to prediction latency: mean {:.3f}s, max {:.3f}s".format(np.mean(latencies), np.max(latencies)))
+        print("Frames captured: {}, dropped: {}".format(self.capture.slot.seq, self.capture.dropped))
         cv2.destroyAllWindows()
 
 
@@ -199,15 +197,12 @@ class PhaseCom(object):
         self.quiet = quiet
         self.record = record
         self.model = self.load_model()
-        self.frame_feature_cache = None
-        self.frame_cache_len = 2 ** (self.arg.mstcn_layers + 1) - 1
-        self.temporal_feature_cache = None
+        # The MS-TCN history lives in fusion_state, so only the steps read by transformer.forward_last are cached
+        self.frame_cache_len = max(self.transformer.len_q, self.transformer.spa_len)
+        self.stream = self.new_stream()
         self.label2phase_dict = label_dict
-        self.aug = A.Compose([
-            A.Resize(250, 250),
-            A.CenterCrop(224, 224),
-            A.Normalize()
-        ])
+        self.preprocessor = FramePreprocessor()
+        self.overlay = TextOverlay(TEXT_ORIGINS)
 
     def save_preds(self, timestamps, frame_idxs, preds):
 
@@ -221,36 +216,115 @@ class PhaseCom(object):
         """
         Function loads the yolo5 model from PyTorch Hub.
         """
-        self.resnet = ResNet(out_channels=self.arg.out_classes, has_fc=False)
-        paras = torch.load(self.arg.resnet_model)["model"]
-        paras = {k: v for k, v in paras.items() if "fc" not in k}
-        paras = {k: v for k, v in paras.items() if "embed" not in k}
-        self.resnet.load_state_dict(paras, strict=True)
-        self.resnet.cuda()
-        self.resnet.eval()
+        if self.arg.backend == "onnx":
+            # Graphs exported by export_onnx.py on the CPU execution provider, onnxruntime is only needed here
+            from utils.onnx_backend import load_onnx_models
+            self.device = torch.device("cpu")
+            self.resnet, self.fusion, self.transformer = load_onnx_models(self.arg)
+            self.light = None
+            return
+
+        self.device = get_device(self.arg.device)
+        self.resnet = load_backbone(self.arg, self.device)
+        # Cascade: the light backbone handles frames by default, ResNet50 runs when CascadeGate asks for it
+        self.light = load_light_backbone(self.arg, self.device) if self.arg.cascade else None
 
         self.fusion = MultiStageModel(mstcn_stages=self.arg.mstcn_stages, mstcn_layers=self.arg.mstcn_layers,
                                       mstcn_f_maps=self.arg.mstcn_f_maps, mstcn_f_dim=self.arg.mstcn_f_dim,
                                       out_features=self.arg.out_classes, mstcn_causal_conv=True, is_train=False)
-        paras = torch.load(self.arg.fusion_model)
+        paras = torch.load(self.arg.fusion_model, map_location=self.device)
         self.fusion.load_state_dict(paras)
-        self.fusion.cuda()
+        self.fusion.to(self.device)
         self.fusion.eval()
 
         self.transformer = Transformer(self.arg.mstcn_f_maps, self.arg.mstcn_f_dim, self.arg.out_classes, self.arg.trans_seq, d_model=self.arg.mstcn_f_maps)
-        paras = torch.load(self.arg.trans_model)
+        paras = torch.load(self.arg.trans_model, map_location=self.device)
         self.transformer.load_state_dict(paras)
-        self.transformer.cuda()
+        self.transformer.to(self.device)
         self.transformer.eval()
 
-    def cache_frame_features(self, feature):
-        if self.frame_feature_cache is None:
-            self.frame_feature_cache = feature
-        elif self.frame_feature_cache.shape[0] > self.frame_cache_len:
-            self.frame_feature_cache = torch.cat([self.frame_feature_cache[1:], feature], dim=0)
-        else:
-            self.frame_feature_cache = torch.cat([self.frame_feature_cache, feature], dim=0)
-        return self.frame_feature_cache
+    def new_stream(self, monitor=None):
+        """
+        :param monitor: LatencyMonitor receiving the backbone, tcn and transformer times of the stream.
+        """
+        detector = None
+        if self.arg.reuse_threshold:
+            detector = ChangeDetector(self.arg.reuse_threshold, self.arg.reuse_max or 10)
+        gate = None
+        if self.light is not None:
+            gate = CascadeGate(self.arg.cascade_confidence or 0.8, self.arg.cascade_drift or 0.1,
+                               self.arg.cascade_interval or 30)
+        return PhaseStream(self.fusion, self.frame_cache_len, monitor, detector, gate)
+
+    def backbone_features(self, inputs, streams):
+        """
+        Backbone features of frames, from the light backbone of the cascade where the gates of their streams allow it.
+        :param inputs: preprocessed frames  [N, 3, 224, 224]
+        :param streams: PhaseStream of every frame.
+        :return: [N, 2048]
+        """
+        with torch.no_grad():
+            if self.light is None:
+                return self.resnet(inputs)
+            features = self.light(inputs)
+            idxs = [i for i, stream in enumerate(streams) if stream.gate.check(features[i:i + 1], stream.confidence)]
+            if idxs:
+                features[idxs] = self.resnet(inputs[idxs])
+        return features
+
+    def synchronize(self):
+        # Kernels run asynchronously on GPU, stage times are only meaningful after waiting for them
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def preprocess(self, frame, bgr=False):
+        """
+        :param frame: RGB frame of any size, or BGR if bgr is set.
+        :return: normalized input of the backbone  [1, 3, 224, 224], owned by the caller, e.g. a PhasePipeline queue.
+        """
+        return self.preprocessor.owned(frame, bgr).to(self.device)
+
+    def seg_feature(self, frame_feature, stream):
+        """
+        Temporal stage for the newest frame of one stream.
+        :param frame_feature: backbone feature of the newest frame  [1, 2048]
+        :param stream: PhaseStream holding the temporal caches of the video.
+        :return: predicted phase.
+        """
+        with torch.no_grad():
+            start_time = time.time()
+            stream.last_feature = frame_feature
+            cat_frame_feature = stream.cache_frame_features(frame_feature).unsqueeze(0)
+            # Only the newest time step goes through the causal MS-TCN, earlier steps are kept in fusion_state
+            temporal_feature = self.fusion.forward_step(frame_feature.unsqueeze(-1), stream.fusion_state)
+            temporal_feature = stream.cache_temporal_features(temporal_feature)
+            if stream.monitor is not None:
+                self.synchronize()
+            tcn_time = time.time()
+
+            # Temporal feature: [1, 32, N], Frame feature：[1, N, 2048]
+            pred = self.transformer.forward_last(temporal_feature.detach(), cat_frame_feature)[-1].cpu().numpy()
+        # Softmax probability of the prediction, read by the cascade gate for the next frame
+        probs = np.exp(pred - pred.max())
+        stream.confidence = float(probs.max() / probs.sum())
+        if stream.monitor is not None:
+            stream.monitor.record("tcn", tcn_time - start_time)
+            stream.monitor.record("transformer", time.time() - tcn_time)
+        return self.label2phase_dict[np.argmax(pred, axis=0)]
+
+    def infer(self, inputs):
+        """
+        :param inputs: frame preprocessed by preprocess  [1, 3, 224, 224]
+        :return: predicted phase.
+        """
+        if self.stream.is_unchanged(inputs):
+            return self.seg_feature(self.stream.last_feature, self.stream)
+        start_time = time.time()
+        frame_feature = self.backbone_features(inputs, [self.stream])
+        if self.stream.monitor is not None:
+            self.synchronize()
+            self.stream.monitor.record("backbone", time.time() - start_time)
+        return self.seg_feature(frame_feature, self.stream)
 
     def seg_frame(self, frame):
         """
@@ -258,23 +332,44 @@ class PhaseCom(object):
         :param frame: frame to be infered.
         :return: labels and coordinates of objects found.
         """
-        frame = cv2.resize(frame, (250, 250))
-        frame = self.aug(image=frame)["image"]
-        with torch.no_grad():
-            frame = np.expand_dims(np.transpose(frame, [2, 0, 1]), axis=0)
-            frame = torch.tensor(frame).cuda()
-            frame_feature = self.resnet(frame)
-            # print(frame_feature.size())
-            cat_frame_feature = self.cache_frame_features(frame_feature).unsqueeze(0)
-            temporal_feature = self.fusion(cat_frame_feature.transpose(1, 2))
+        return self.infer(self.preprocess(frame))
 
-            # Temporal feature: [1, 5, 512], Frame feature：[1, 512, 2048]
-            pred = self.transformer(temporal_feature.detach(), cat_frame_feature)[-1].cpu().numpy()
-        return self.label2phase_dict[np.argmax(pred, axis=0)]
+    def add_text(self, fc, results, fps, frame, overlay=None):
+        """
+        :param overlay: TextOverlay of the calling stream, clients of a shared PhaseCom keep their own text caches.
+        """
+        texts = ["   Time: {:<55s}".format(fc), "  Phase: {:<15s}".format(results), " Trainee: {:<15s}".format(fps)]
+        return (overlay or self.overlay).draw(texts, frame)
 
-    def add_text(self, fc, results, fps, frame):
-        cv2.putText(frame, "   Time: {:<55s}".format(fc), (30, 30),  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-        cv2.putText(frame, "  Phase: {:<15s}".format(results), (30, 60),  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-        cv2.putText(frame, " Trainee: {:<15s}".format(fps), (30, 90),  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+class PhaseStream(object):
+    """
+    Temporal caches of one video stream, the models of PhaseCom are shared by all streams.
+    """
+    def __init__(self, fusion, cache_len, monitor=None, detector=None, gate=None):
+        """
+        :param detector: ChangeDetector deciding when the backbone feature of the last frame is reused, None disables reuse.
+        :param gate: CascadeGate of the stream if PhaseCom has a light backbone.
+        """
+        self.fusion_state = fusion.init_stream()
+        self.monitor = monitor
+        self.detector = detector
+        self.gate = gate
+        self.last_feature = None
+        self.confidence = None  # Softmax probability of the last prediction
+        self.frame_feature_cache = FeatureCache(cache_len)
+        self.temporal_feature_cache = FeatureCache(cache_len)
+
+    def is_unchanged(self, inputs):
+        """
+        Frames must be checked in stream order, a changed frame becomes the reference of the following frames.
+        :param inputs: preprocessed frame  [1, 3, 224, 224]
+        :return: True if the frame can use last_feature instead of running the backbone.
+        """
+        return self.detector is not None and self.detector.check(inputs)
+
+    def cache_frame_features(self, feature):
+        return self.frame_feature_cache.append(feature)
 
-        return frame
\ No newline at end of file
+    def cache_temporal_features(self, feature):
+        # [1, C, 1] is cached as one row per time step and returned as [1, C, N]
+        return self.temporal_feature_cache.append(feature[0].t()).t().unsqueeze(0)
@@ -0,0 +1,103 @@
+import math
+import time
+import logging
+from threading import Lock
+
+import numpy as np
+
+STAGES = ["decode", "preprocess", "backbone", "tcn", "transformer", "overlay", "encode", "display", "total"]
+
+
+class LatencyHistogram(object):
+    """
+    Fixed-size histogram of durations with logarithmic bins, so memory and cost per sample stay constant
+    over a session and percentiles are accurate to the relative bin width (about 5% by default).
+    """
+    def __init__(self, min_time=1e-5, max_time=10., num_bins=300):
+        """
+        :param min_time: upper edge in seconds of the first bin, shorter durations are counted there.
+        :param max_time: lower edge in seconds of the last bin, longer durations are counted there.
+        """
+        self.log_min = math.log(min_time)
+        self.log_step = (math.log(max_time) - self.log_min) / num_bins
+        self.num_bins = num_bins
+        self.counts = np.zeros(num_bins + 2, dtype=np.int64)
+        self.lock = Lock()
+
+    def add(self, seconds):
+        if seconds <= 0:
+            idx = 0
+        else:
+            idx = min(max(int((math.log(seconds) - self.log_min) // self.log_step) + 1, 0), self.num_bins + 1)
+        with self.lock:
+            self.counts[idx] += 1
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def reset(self):
+        with self.lock:
+            self.counts[:] = 0
+
+    def percentile(self, q):
+        """
+        :param q: percentile in [0, 100].
+        :return: duration in seconds at the geometric center of the bin holding the percentile, None if empty.
+        """
+        with self.lock:
+            cum_counts = np.cumsum(self.counts)
+        if cum_counts[-1] == 0:
+            return None
+        idx = int(np.searchsorted(cum_counts, q / 100. * cum_counts[-1]))
+        idx = min(max(idx, 1), self.num_bins)
+        return math.exp(self.log_min + (idx - 0.5) * self.log_step)
+
+
+class LatencyMonitor(object):
+    """
+    Per-stage latency histograms of one video stream, shared by the capture, inference and GUI threads.
+    """
+    def __init__(self, stages=STAGES, log_interval=60.):
+        """
+        :param log_interval: seconds between two periodic log lines.
+        """
+        self.stages = list(stages)
+        self.histograms = {stage: LatencyHistogram() for stage in self.stages}
+        self.log_interval = log_interval
+        self.last_log = time.time()
+
+    def record(self, stage, seconds):
+        self.histograms[stage].add(seconds)
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.last_log = time.time()
+
+    def percentiles(self, stage, qs=(50, 95, 99)):
+        """
+        :return: percentiles in seconds, None if the stage has no samples.
+        """
+        histogram = self.histograms[stage]
+        if len(histogram) == 0:
+            return None
+        return [histogram.percentile(q) for q in qs]
+
+    def summary(self, stages=None):
+        """
+        p50/p95/p99 in ms of every stage with samples, e.g. "backbone 41.2/45.0/52.3".
+        """
+        items = []
+        for stage in self.stages if stages is None else stages:
+            values = self.percentiles(stage)
+            if values is not None:
+                items.append("{} {}".format(stage, "/".join("{:.1f}".format(v * 1000) for v in values)))
+        return " | ".join(items)
+
+    def log(self, force=False):
+        """
+        Write the summary to the log at most once per log_interval unless forced.
+        """
+        if force or time.time() - self.last_log >= self.log_interval:
+            self.last_log = time.time()
+            logging.info("Latency p50/p95/p99 [ms]: " + self.summary())
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import torch
+import onnxruntime as ort
+
+from model.mstcn import StreamState
+
+BACKBONE_FILE = "backbone.onnx"
+TCN_FILE = "tcn_step.onnx"
+TRANSFORMER_FILE = "transformer_step.onnx"
+
+
+def create_session(model_file, num_threads=0):
+    """
+    ONNX Runtime session on the CPU execution provider with all graph optimizations.
+    :param num_threads: intra-op threads, 0 lets ONNX Runtime decide.
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(model_file, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def to_numpy(tensor):
+    return np.ascontiguousarray(tensor.detach().cpu().numpy(), dtype=np.float32)
+
+
+class OnnxBackbone(object):
+    """
+    ResNet50 feature extractor on ONNX Runtime, called like the eager ResNet.
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {"frames": to_numpy(x)})[0])
+
+
+class OnnxTCN(object):
+    """
+    Streaming MS-TCN on ONNX Runtime with the init_stream / forward_step interface of MultiStageModel.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.history_shape = session.get_inputs()[1].shape[1:]  # [num_f_maps, history size]
+
+    def init_stream(self, batch_size=1):
+        return StreamState(np.zeros([batch_size] + list(self.history_shape), dtype=np.float32))
+
+    def forward_step(self, x, state):
+        out, state.buffers = self.session.run(None, {"x": to_numpy(x), "history": state.buffers})
+        state.step += 1
+        return torch.from_numpy(out)
+
+
+class OnnxTransformer(object):
+    """
+    Transformer on ONNX Runtime with the forward_last interface of Transformer.
+    """
+    def __init__(self, session, len_q, spa_len):
+        self.session = session
+        self.len_q = len_q
+        self.spa_len = spa_len
+        self.d_model = session.get_inputs()[0].shape[2]
+        self.dim = session.get_inputs()[1].shape[2]
+
+    def forward_last(self, x, long_feature):
+        """
+        :param x: Shifted frame-wise predictions  [B, d_model, N]
+        :param long_feature: Long-range spatial features  [B, N, 2048]
+        :return: prediction of the newest frame  [B, out_features].
+        """
+        out_features = to_numpy(x.transpose(1, 2))
+        bs, seq_len = out_features.shape[0], out_features.shape[1]
+        inputs = np.zeros((bs, self.len_q, self.d_model), dtype=np.float32)
+        num = min(seq_len, self.len_q)
+        inputs[:, self.len_q - num:] = out_features[:, seq_len - num:]
+
+        frame_feas = np.zeros((bs, self.spa_len, self.dim), dtype=np.float32)
+        temporal_feas = np.zeros((bs, self.spa_len, self.d_model), dtype=np.float32)
+        if seq_len < self.spa_len:
+            frame_feas[:, self.spa_len - seq_len:] = to_numpy(long_feature)
+            use_frame = np.ones((bs, 1, 1), dtype=np.float32)
+        else:
+            temporal_feas[:] = out_features[:, -self.spa_len:]
+            use_frame = np.zeros((bs, 1, 1), dtype=np.float32)
+        output = self.session.run(None, {"inputs": inputs, "frame_feas": frame_feas,
+                                         "temporal_feas": temporal_feas, "use_frame": use_frame})[0]
+        return torch.from_numpy(output)
+
+
+def load_onnx_models(arg):
+    """
+    Load the graphs written by export_onnx.py from onnx_dir.
+    :return: backbone, MS-TCN and transformer with the interfaces used by PhaseCom.
+    """
+    num_threads = arg.onnx_threads or 0
+    resnet = OnnxBackbone(create_session(os.path.join(arg.onnx_dir, BACKBONE_FILE), num_threads))
+    fusion = OnnxTCN(create_session(os.path.join(arg.onnx_dir, TCN_FILE), num_threads))
+    session = create_session(os.path.join(arg.onnx_dir, TRANSFORMER_FILE), num_threads)
+    inputs = session.get_inputs()
+    transformer = OnnxTransformer(session, len_q=inputs[0].shape[1], spa_len=inputs[2].shape[1])
+    return resnet, fusion, transformer
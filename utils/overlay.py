@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+
+
+class TextOverlay(object):
+    """
+    Text lines drawn like cv2.putText, but every line is rendered into a small cached alpha patch only when its
+    text changes. Drawing a frame blends the patches into their regions, so the cost does not depend on the frame size.
+    """
+    def __init__(self, origins, font=cv2.FONT_HERSHEY_SIMPLEX, scale=0.8, color=(0, 255, 0), thickness=2):
+        """
+        :param origins: bottom-left corner of every line, as in cv2.putText.
+        """
+        self.origins = origins
+        self.font = font
+        self.scale = scale
+        self.color = color
+        self.thickness = thickness
+        self.texts = [None] * len(origins)
+        self.patches = [None] * len(origins)  # (top, left, color patch, alpha, 1 - alpha) of every line
+
+    def render(self, text, origin):
+        (width, height), baseline = cv2.getTextSize(text, self.font, self.scale, self.thickness)
+        pad = self.thickness
+        mask = np.zeros((height + baseline + 2 * pad, width + 2 * pad), dtype=np.uint8)
+        cv2.putText(mask, text, (pad, height + pad), self.font, self.scale, 255, self.thickness)
+        rows, cols = np.where(mask.any(axis=1))[0], np.where(mask.any(axis=0))[0]
+        if len(rows) == 0:  # Blank text
+            return None
+        # Only the bounding box of the text pixels is kept, trailing padding spaces are dropped
+        alpha = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].astype(np.float32) / 255
+        patch = np.empty(alpha.shape + (3,), dtype=np.uint8)
+        patch[:] = self.color
+        top, left = origin[1] - height - pad + rows[0], origin[0] - pad + cols[0]
+        return top, left, patch, alpha, 1 - alpha
+
+    def draw(self, texts, frame):
+        """
+        :param texts: text of every line.
+        :param frame: HxWx3 uint8 frame, drawn in place.
+        :return: frame
+        """
+        for idx, text in enumerate(texts):
+            if text != self.texts[idx]:
+                self.patches[idx] = self.render(text, self.origins[idx])
+                self.texts[idx] = text
+            if self.patches[idx] is None:
+                continue
+            top, left, patch, alpha, inv_alpha = self.patches[idx]
+            # Clip the patch to the frame
+            y1, x1 = max(top, 0), max(left, 0)
+            y2, x2 = min(top + alpha.shape[0], frame.shape[0]), min(left + alpha.shape[1], frame.shape[1])
+            if y1 >= y2 or x1 >= x2:
+                continue
+            crop = (slice(y1 - top, y2 - top), slice(x1 - left, x2 - left))
+            roi = frame[y1:y2, x1:x2]
+            roi[:] = cv2.blendLinear(roi, patch[crop], inv_alpha[crop], alpha[crop])
+        return frame
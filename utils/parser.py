@@ -105,7 +105,8 @@ class ParserUse(AttrDict):
             setup(self, log, self.log_time)
 
     def add_args(self, args):
-        self.merge(vars(args))
+        # Options left unset on the command line keep the values of the config file
+        self.merge({k: v for k, v in vars(args).items() if v is not None or k not in self})
         return self
 
     def add_cfg(self, cfg, args=None, update=False, log_time=""):
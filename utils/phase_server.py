@@ -0,0 +1,148 @@
+import time
+import queue
+import logging
+from threading import Thread
+from concurrent.futures import Future
+
+import torch
+
+from utils.guis import PhaseCom, TEXT_ORIGINS
+from utils.overlay import TextOverlay
+from utils.preprocess import FramePreprocessor
+
+
+class PhaseRequest(object):
+    def __init__(self, stream, inputs):
+        self.stream = stream
+        self.inputs = inputs
+        self.time = time.time()
+        self.future = Future()
+
+
+class PhaseServer(object):
+    """
+    Shares one copy of the models between several video streams, e.g. the beds of a training session.
+    Frames submitted by all streams are micro-batched through the ResNet50 backbone. A batch is closed
+    when it holds max_batch frames or when its oldest frame has waited max_wait seconds, then the
+    temporal models run on the caches of each frame's own stream.
+    """
+    def __init__(self, arg, max_batch=8, max_wait=0.02):
+        """
+        :param arg: configs of PhaseCom.
+        :param max_batch: maximum number of frames in one backbone call.
+        :param max_wait: latency deadline in seconds for collecting a batch.
+        """
+        self.phasecom = PhaseCom(arg=arg)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.running = True
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_client(self, monitor=None):
+        """
+        :param monitor: LatencyMonitor of the stream, see PhaseCom.new_stream.
+        """
+        return PhaseClient(self, self.phasecom.new_stream(monitor))
+
+    def submit(self, stream, inputs):
+        """
+        :param stream: PhaseStream of the video the frame belongs to.
+        :param inputs: frame preprocessed by PhaseCom.preprocess  [1, 3, 224, 224]
+        :return: Future resolved with the predicted phase.
+        """
+        request = PhaseRequest(stream, inputs)
+        self.requests.put(request)
+        return request.future
+
+    def collect(self):
+        request = self.requests.get()
+        if request is None:  # Woken up by close
+            return []
+        batch = [request]
+        deadline = request.time + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return [request for request in batch if request is not None]
+
+    def process(self, batch):
+        try:
+            # Unchanged frames reuse the feature of the previous frame of their stream and skip the backbone
+            unchanged = [request.stream.is_unchanged(request.inputs) for request in batch]
+            computed = [request for request, reuse in zip(batch, unchanged) if not reuse]
+            if computed:
+                start_time = time.time()
+                frames = torch.cat([request.inputs for request in computed], dim=0)
+                frame_features = self.phasecom.backbone_features(frames, [request.stream for request in computed])
+                monitors = [request.stream.monitor for request in computed if request.stream.monitor is not None]
+                if monitors:
+                    self.phasecom.synchronize()
+                    # Every frame of the batch waited for the whole backbone call
+                    for monitor in monitors:
+                        monitor.record("backbone", time.time() - start_time)
+            # Frames of the same stream stay in submission order, so last_feature is the one of the previous frame
+            i = 0
+            for request, reuse in zip(batch, unchanged):
+                if reuse:
+                    frame_feature = request.stream.last_feature
+                else:
+                    frame_feature = frame_features[i:i + 1]
+                    i += 1
+                request.future.set_result(self.phasecom.seg_feature(frame_feature, request.stream))
+        except Exception as e:
+            logging.error(f"Error in phase server: {e}")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+    def run(self):
+        while self.running:
+            batch = self.collect()
+            if batch:
+                self.process(batch)
+
+    def close(self):
+        self.running = False
+        self.requests.put(None)  # Wake up the worker
+        self.thread.join()
+        while not self.requests.empty():
+            request = self.requests.get()
+            if request is not None:
+                request.future.cancel()
+
+
+class PhaseClient(object):
+    """
+    Handle of one stream on a PhaseServer, with the interface of PhaseCom.
+    Preprocessing runs in the calling thread, only backbone and temporal models run on the server.
+    """
+    def __init__(self, server, stream):
+        self.server = server
+        self.stream = stream
+        # Own preprocessor, clients preprocess concurrently in their capture threads
+        self.preprocessor = FramePreprocessor()
+        self.overlay = TextOverlay(TEXT_ORIGINS)
+
+    def preprocess(self, frame, bgr=False):
+        # A request can wait in the server queue while later frames are preprocessed, so it owns its input
+        return self.preprocessor.owned(frame, bgr).to(self.server.phasecom.device)
+
+    def submit(self, inputs):
+        return self.server.submit(self.stream, inputs)
+
+    def infer(self, inputs):
+        return self.submit(inputs).result()
+
+    def seg_frame(self, frame):
+        return self.infer(self.preprocess(frame))
+
+    def add_text(self, fc, results, fps, frame, overlay=None):
+        """
+        :param overlay: TextOverlay drawn with instead of the one of this client, e.g. for frames of another size.
+        """
+        return self.server.phasecom.add_text(fc, results, fps, frame, overlay or self.overlay)
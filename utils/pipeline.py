@@ -0,0 +1,89 @@
+import time
+import queue
+import logging
+from threading import Thread
+
+
+def put_latest(q, item):
+    """
+    Put item into a bounded queue, dropping the oldest entries when it is full.
+    """
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class PhasePipeline(object):
+    """
+    Staged inference of one video stream: capture -> preprocess -> inference -> callback.
+    Stages run in their own worker threads and are connected by queues of size one that keep
+    only the freshest item, so a slow model never blocks capture or display and always works
+    on the newest frame.
+    """
+    def __init__(self, phaseseg, callback, monitor=None):
+        """
+        :param phaseseg: PhaseClient (or PhaseCom-like object) providing preprocess and infer.
+        :param callback: called from the inference thread with (pred, date_time, frame_idx, latency).
+        :param monitor: LatencyMonitor receiving the preprocess and total (capture to prediction) times.
+        """
+        self.phaseseg = phaseseg
+        self.callback = callback
+        self.monitor = monitor
+        self.capture_queue = queue.Queue(maxsize=1)
+        self.infer_queue = queue.Queue(maxsize=1)
+        self.running = True
+        self.threads = [Thread(target=self.run_preprocess, args=()),
+                        Thread(target=self.run_inference, args=())]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, frame, frame_idx, date_time):
+        """
+        Hand over a BGR frame from the capture thread, never blocks.
+        """
+        if self.running:
+            put_latest(self.capture_queue, (frame, frame_idx, date_time, time.time()))
+
+    def run_preprocess(self):
+        while True:
+            item = self.capture_queue.get()
+            if item is None or not self.running:
+                put_latest(self.infer_queue, None)
+                break
+            frame, frame_idx, date_time, start_time = item
+            try:
+                preprocess_time = time.time()
+                inputs = self.phaseseg.preprocess(frame, bgr=True)
+                if self.monitor is not None:
+                    self.monitor.record("preprocess", time.time() - preprocess_time)
+                put_latest(self.infer_queue, (inputs, frame_idx, date_time, start_time))
+            except Exception as e:
+                logging.error(f"Error in preprocessing: {e}")
+
+    def run_inference(self):
+        while True:
+            item = self.infer_queue.get()
+            if item is None or not self.running:
+                break
+            inputs, frame_idx, date_time, start_time = item
+            try:
+                pred = self.phaseseg.infer(inputs)
+                latency = time.time() - start_time
+                if self.monitor is not None:
+                    self.monitor.record("total", latency)
+                self.callback(pred, date_time, frame_idx, latency)
+            except Exception as e:
+                logging.error(f"Error in inference: {e}")
+
+    def close(self):
+        self.running = False
+        put_latest(self.capture_queue, None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,61 @@
+import cv2
+import torch
+import numpy as np
+
+# Defaults of albumentations.Normalize
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class FramePreprocessor(object):
+    """
+    Single-pass replacement of Resize(250) + CenterCrop(224) + Normalize + HWC->CHW for inference.
+    The frame is resized once, the center crop is a view of the resized frame, and scaling, mean
+    subtraction and the optional BGR->RGB swap are written per channel straight into a preallocated
+    [1, 3, crop, crop] float tensor.
+    """
+    def __init__(self, resize=250, crop=224, mean=IMAGENET_MEAN, std=IMAGENET_STD, num_buffers=3):
+        """
+        :param resize: side length of the resized frame.
+        :param crop: side length of the center crop fed to the backbone.
+        :param num_buffers: number of output tensors used in turn, an output is overwritten num_buffers calls later.
+            This only suits callers that consume every output before preprocessing further frames. Where frames
+            are dropped from queues, as in PhasePipeline and PhaseServer, a pending output can be held for any
+            number of calls, so those use owned().
+        """
+        self.resize = resize
+        self.crop = crop
+        self.top = (resize - crop) // 2
+        mean = np.array(mean, dtype=np.float32)
+        std = np.array(std, dtype=np.float32)
+        # (x / 255 - mean) / std == x * scale + offset
+        self.scale = 1 / (255 * std)
+        self.offset = -mean / std
+        self.buffers = [torch.empty((1, 3, crop, crop), dtype=torch.float32) for _ in range(num_buffers)]
+        self.pos = 0
+
+    def __call__(self, frame, bgr=False, out=None):
+        """
+        :param frame: uint8 frame of any size  [H, W, 3]
+        :param bgr: frame channels are BGR as read by OpenCV, swapped to RGB while normalizing.
+        :param out: float32 tensor [1, 3, crop, crop] written into, the next rotating buffer if None.
+        :return: normalized input of the backbone  [1, 3, crop, crop], on CPU.
+        """
+        resized = cv2.resize(frame, (self.resize, self.resize))
+        patch = resized[self.top:self.top + self.crop, self.top:self.top + self.crop]
+        if out is None:
+            output = self.buffers[self.pos]
+            self.pos = (self.pos + 1) % len(self.buffers)
+        else:
+            output = out
+        planes = output.numpy()[0]
+        for c in range(3):
+            np.multiply(patch[:, :, 2 - c if bgr else c], self.scale[c], out=planes[c])
+            planes[c] += self.offset[c]
+        return output
+
+    def owned(self, frame, bgr=False):
+        """
+        Preprocess into a new tensor, which stays valid as long as the caller holds it.
+        """
+        return self(frame, bgr, out=torch.empty((1, 3, self.crop, self.crop), dtype=torch.float32))
@@ -0,0 +1,91 @@
+import os
+import time
+import queue
+import logging
+from threading import Thread
+
+import cv2
+
+
+class VideoRecorder(object):
+    """
+    Records frames in its own thread, so a slow disk never blocks capture or inference.
+    Frames are handed over through a bounded queue, a frame that does not fit is dropped and counted.
+    The output is split into segments of a fixed duration, named <name>_000.avi, <name>_001.avi, ...
+    """
+    def __init__(self, video_file, fps, codec=None, segment_seconds=600, max_queue=64, rgb=False, monitor=None):
+        """
+        :param video_file: path of the recording, the segment index is appended to its name.
+        :param fps: frame rate of the written video.
+        :param codec: fourcc of cv2.VideoWriter, MJPG if not given.
+        :param segment_seconds: video duration of one segment.
+        :param max_queue: number of frames waiting for the encoder before frames are dropped.
+        :param rgb: frames are RGB and converted to BGR in the recording thread.
+        :param monitor: LatencyMonitor receiving the encode times.
+        """
+        self.root, self.ext = os.path.splitext(video_file)
+        self.fps = fps
+        self.codec = cv2.VideoWriter_fourcc(*"MJPG") if codec is None else codec
+        self.segment_frames = max(1, int(round(segment_seconds * fps)))
+        self.rgb = rgb
+        self.monitor = monitor
+        self.frames = queue.Queue(maxsize=max_queue)
+        self.writer = None
+        self.segments = []
+        self.segment_count = 0  # Frames written to the current segment
+        self.written = 0
+        self.dropped = 0
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, frame):
+        """
+        Queue a frame without blocking, the frame must not be modified afterwards.
+        :return: False if the frame was dropped.
+        """
+        try:
+            self.frames.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def open_segment(self, frame):
+        if self.writer is not None:
+            self.writer.release()
+        video_file = "{}_{:03d}{}".format(self.root, len(self.segments), self.ext)
+        height, width = frame.shape[:2]
+        self.writer = cv2.VideoWriter(video_file, self.codec, self.fps, (width, height))
+        self.segments.append(video_file)
+        self.segment_count = 0
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                start_time = time.time()
+                if self.writer is None or self.segment_count >= self.segment_frames:
+                    self.open_segment(frame)
+                if self.rgb:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                self.writer.write(frame)
+                self.segment_count += 1
+                self.written += 1
+                if self.monitor is not None:
+                    self.monitor.record("encode", time.time() - start_time)
+            except Exception as e:
+                logging.error(f"Error in video recorder: {e}")
+        if self.writer is not None:
+            self.writer.release()
+
+    def close(self):
+        """
+        Write the queued frames and close the last segment.
+        """
+        self.frames.put(None)
+        self.thread.join()
+        logging.info("Recorded {} frames in {} segments, {} frames dropped".format(
+            self.written, len(self.segments), self.dropped))
@@ -0,0 +1,127 @@
+import os
+import zlib
+import pickle
+import logging
+import argparse
+from threading import Thread, Condition
+
+import pandas as pd
+
+LOG_COLUMNS = ["Time", "Frame", "Trainee", "Trainer", "Bed", "Status", "FPS", "Prediction", "Correction"]
+
+
+class SessionLog(object):
+    """
+    Append-only log of an online session. Rows are buffered and written as column chunks, so memory stays
+    constant over a session and a crash loses at most the rows since the last flush.
+    Chunks are compressed, written and synced to disk by a writer thread, append only buffers the row, so the
+    GUI thread never waits for a slow disk.
+    The file holds pickled records: the column names first, then one compressed list per column for every chunk.
+    """
+    def __init__(self, log_file, columns=LOG_COLUMNS, flush_rows=256, flush_interval=5.):
+        """
+        :param log_file: path of the session log, it is not a csv file, so generate_report does not read it.
+        :param columns: names of the row values.
+        :param flush_rows: rows buffered before a chunk is written.
+        :param flush_interval: seconds after which buffered rows are written and synced to disk.
+        """
+        self.log_file = log_file
+        self.columns = list(columns)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.num_rows = 0
+        self.closed = False
+        self.cond = Condition()
+        self.file = open(log_file, "wb")
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, row):
+        """
+        Rows appended from another thread after close are ignored.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.rows.append(row)
+            self.num_rows += 1
+            if len(self.rows) >= self.flush_rows:
+                self.cond.notify()
+
+    def run(self):
+        pickle.dump(self.columns, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or len(self.rows) >= self.flush_rows, self.flush_interval)
+                rows, self.rows = self.rows, []
+                closed = self.closed
+            try:
+                self.write(rows)
+            except Exception as e:
+                logging.error(f"Error in session log: {e}")
+            if closed:
+                break
+        self.file.close()
+
+    def write(self, rows):
+        if rows:
+            chunk = pickle.dumps([list(column) for column in zip(*rows)], protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(zlib.compress(chunk), self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """
+        Write the remaining rows and wait until they are on disk.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def read_chunks(log_file):
+    """
+    Yield the chunks of a session log as data frames, a chunk cut off by a crash ends the log.
+    """
+    with open(log_file, "rb") as f:
+        columns = pickle.load(f)
+        while True:
+            try:
+                chunk = pickle.loads(zlib.decompress(pickle.load(f)))
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, zlib.error, ValueError, IndexError):
+                logging.error(f"Session log {log_file} is truncated, later rows are lost")
+                break
+            yield pd.DataFrame(dict(zip(columns, chunk)), columns=columns)
+
+
+def export_csv(log_file, csv_file):
+    """
+    Write a session log in the csv format read by report_tools.get_meta, with the Combine column after Correction.
+    :return: number of exported rows, no file is written for an empty log.
+    """
+    num_rows = 0
+    for pd_log in read_chunks(log_file):
+        pd_log = pd_log.fillna("--").astype(str)
+        if "Correction" in pd_log.columns:
+            combines = [corr if corr != "--" else pred for pred, corr in zip(pd_log["Prediction"], pd_log["Correction"])]
+            pd_log.insert(pd_log.columns.get_loc("Correction") + 1, "Combine", combines)
+        pd_log.to_csv(csv_file, mode="w" if num_rows == 0 else "a", index=False, header=num_rows == 0)
+        num_rows += len(pd_log)
+    return num_rows
+
+
+if __name__ == "__main__":
+    # Recover the csv log of a session that was not stopped normally
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_file", type=str, help="Session log to export")
+    parser.add_argument("-o", "--output", default=None, type=str, help="Csv file, next to the session log by default")
+    args = parser.parse_args()
+    csv_file = args.output or os.path.splitext(args.log_file)[0] + ".csv"
+    print("Exported {} rows to {}".format(export_csv(args.log_file, csv_file), csv_file))
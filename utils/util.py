@@ -2,6 +2,7 @@ import math
 import os.path
 
 import numpy as np
+import torch
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
@@ -183,6 +184,14 @@ def annotate_heatmap(im, data=None, valfmt="{x:.2f}",
 
     return texts
 
+def get_device(device=None):
+    """
+    Resolve the device setting of the configs, "auto" or an empty setting selects cuda when it is available.
+    """
+    if not device or device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']